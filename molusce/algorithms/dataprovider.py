@@ -1,12 +1,16 @@
 # encoding: utf-8
 
+import os
+import tempfile
+
 from osgeo import gdal
 from osgeo import osr
 
 import numpy as np
 from numpy import ma as ma
 
-from utils import binaryzation, reclass, get_gradations
+from utils import binaryzation, reclass, pack_mask, unpack_mask, CHUNK_SIZE
+from parallel import prefetch, ThreadedWriter
 
 class ProviderError(Exception):
     '''Base class for exceptions in this module.'''
@@ -18,35 +22,290 @@ class FormatConverter(object):
     def __init__(self):
         self.dtypes = np.bool, np.int, np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64, np.float, np.float16, np.float32, np.float64
         self.GDT = gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_Int16, gdal.GDT_UInt32, gdal.GDT_Int32, gdal.GDT_Float32, gdal.GDT_Float64
+        # Lossless mapping
         self.dtype2GDT = {
             np.dtype('bool'): gdal.GDT_Byte,
-            np.dtype('int'): gdal.GDT_Int32,#!!!
             np.dtype('int8'): gdal.GDT_Int16,
             np.dtype('int16'): gdal.GDT_Int16,
             np.dtype('int32'): gdal.GDT_Int32,
-            np.dtype('int64'): gdal.GDT_Int32,#!!!
             np.dtype('uint8'): gdal.GDT_Byte,
             np.dtype('uint16'): gdal.GDT_UInt16,
             np.dtype('uint32'): gdal.GDT_UInt32,
-            np.dtype('uint64'): gdal.GDT_UInt32,#!!!
-            np.dtype('float'): gdal.GDT_Float64,
             np.dtype('float16'): gdal.GDT_Float32,
             np.dtype('float32'): gdal.GDT_Float32,
             np.dtype('float64'): gdal.GDT_Float64
         }
+        # Types of the new GDAL versions
+        if hasattr(gdal, 'GDT_Int8'):
+            self.dtype2GDT[np.dtype('int8')] = gdal.GDT_Int8
+        if hasattr(gdal, 'GDT_Int64'):
+            self.dtype2GDT[np.dtype('int64')] = gdal.GDT_Int64
+            self.dtype2GDT[np.dtype('uint64')] = gdal.GDT_UInt64
+
+    def getRasterType(self, dtype, minValue=None, maxValue=None):
+        '''
+        Return GDAL data type that stores the values of dtype without loss.
+        If GDAL doesn't support the dtype (64-bit integers in old GDAL versions),
+        the smallest GDAL integer type that contains [minValue, maxValue] range is returned.
+        '''
+        dtype = np.dtype(dtype)
+        if dtype in self.dtype2GDT:
+            return self.dtype2GDT[dtype]
+        if dtype.kind in 'iu' and minValue is not None and maxValue is not None:
+            for gdt, t in [(gdal.GDT_Byte, np.uint8), (gdal.GDT_UInt16, np.uint16), (gdal.GDT_Int16, np.int16),
+                           (gdal.GDT_UInt32, np.uint32), (gdal.GDT_Int32, np.int32)]:
+                info = np.iinfo(t)
+                if info.min <= minValue and maxValue <= info.max:
+                    return gdt
+        raise ProviderError("The data type %s can't be saved without loss!" % dtype)
+
+
+class RasterWriter(object):
+    '''Writes raster file block by block, so the bands can be written while they are computed.
+
+    Usage:
+        writer = RasterWriter(filename, geodata, bandcount, gdal.GDT_Byte, options=RasterWriter.gtiffOptions(gdal.GDT_Byte))
+        for row, col, blocks in blockGenerator:     # (see Raster.iterBlocks)
+            writer.write(1, row, col, blocks[0])
+        writer.close()
+    '''
+    def __init__(self, filename, geodata, bandcount, rastertype, format="GTiff", nodata=0, options=None):
+        '''
+        @param filename     Name of the raster file.
+        @param geodata      Georeferensing information of the raster (see Raster.getGeodata).
+        @param bandcount    Count of the bands.
+        @param rastertype   GDAL data type of the bands.
+        @param format       GDAL driver name.
+        @param nodata       NoData value, masked pixels are written as nodata.
+        @param options      List of the creation options of the driver, for example
+                                ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER']
+        '''
+        driver = gdal.GetDriverByName(format)
+        metadata = driver.GetMetadata()
+        if not (metadata.has_key(gdal.DCAP_CREATE) and metadata[gdal.DCAP_CREATE] == "YES"):
+            raise ProviderError("Driver %s does not support Create() method!" % format)
+        if not options: options = []
+
+        self.nodata = nodata
+        self.dataset = driver.Create(filename, geodata['xSize'], geodata['ySize'], bandcount, rastertype, options)
+        if self.dataset is None:
+            raise ProviderError("Can't create the file '%s'" % filename)
+        self.dataset.SetProjection(geodata['proj'])
+        self.dataset.SetGeoTransform(geodata['transform'])
+        for i in range(1, bandcount+1):
+            self.dataset.GetRasterBand(i).SetNoDataValue(nodata)
+
+    @staticmethod
+    def gtiffOptions(rastertype, tiled=True, blockSize=256, compress='DEFLATE', bigtiff='IF_SAFER'):
+        '''
+        Return creation options of tiled compressed GeoTIFF.
+        The predictor is chosen by rastertype: horizontal differencing for integers, floating point predictor for floats.
+        '''
+        options = ['BIGTIFF=%s' % bigtiff]
+        if tiled:
+            options = options + ['TILED=YES', 'BLOCKXSIZE=%s' % blockSize, 'BLOCKYSIZE=%s' % blockSize]
+        if compress:
+            options.append('COMPRESS=%s' % compress)
+            if compress in ['DEFLATE', 'LZW']:
+                if rastertype in [gdal.GDT_Float32, gdal.GDT_Float64]:
+                    options.append('PREDICTOR=3')
+                else:
+                    options.append('PREDICTOR=2')
+        return options
+
+    def close(self):
+        '''Flush the data and close the file.'''
+        if self.dataset is not None:
+            self.dataset.FlushCache()
+            self.dataset = None
+
+    def write(self, bandNo, row, col, block):
+        '''
+        Write the block (array or masked array) into the band, (row, col) is the top left pixel of the block.
+        '''
+        self.dataset.GetRasterBand(bandNo).WriteArray(ma.filled(block, self.nodata), col, row)
+
+    def writeBlocks(self, blocks):
+        '''
+        Write the blocks of the bands.
+        @param blocks       Iterable of (row, col, [block of band 1, block of band 2, ...]) tuples (see Raster.iterBlocks).
+        '''
+        for row, col, bands in blocks:
+            for i, block in enumerate(bands):
+                self.write(i+1, row, col, block)
+
+
+class RastersWriter(object):
+    '''Writes blocks into the bands of new one-band rasters (in memory), band k of the writer is the band of rasters[k-1].
+    The usage is the same as the usage of RasterWriter, so the rasters can be computed block by block:
+        writer = RastersWriter(geodata, [np.uint8, np.float32])
+        for row, col, blocks in blockGenerator:
+            writer.writeBlocks([(row, col, blocks)])
+        writer.close()
+        prediction, confidence = writer.rasters
+    The pixels that are not written stay masked.
+    '''
+    def __init__(self, geodata, dtypes):
+        '''
+        @param geodata      Georeferensing information of the rasters (see Raster.getGeodata).
+        @param dtypes       List of dtypes of the rasters.
+        '''
+        shape = (geodata['ySize'], geodata['xSize'])
+        self.rasters = []
+        for dtype in dtypes:
+            raster = Raster()
+            raster.create([ma.array(data=np.zeros(shape, dtype=dtype), mask=np.ones(shape, dtype=np.bool))], geodata)
+            self.rasters.append(raster)
+
+    def close(self):
+        pass
+
+    def write(self, bandNo, row, col, block):
+        '''
+        Write the block (masked array) into the raster, (row, col) is the top left pixel of the block (see Raster.setBlock).
+        '''
+        self.rasters[bandNo-1].setBlock(1, row, col, block)
+
+    def writeBlocks(self, blocks):
+        '''
+        Write the blocks of the bands (see RasterWriter.writeBlocks).
+        '''
+        for row, col, bands in blocks:
+            for i, block in enumerate(bands):
+                self.write(i+1, row, col, block)
+
+
+class MappedBand(object):
+    '''Band stored in the memory-mapped files: file of the data and file of the bit-packed mask.
+
+    The band is pickled by the file names, so processes can share the band data without copying.
+    The files are removed when the band (the original object, not an unpickled copy or a copy in a forked process) is deleted.
+    '''
+    def __init__(self, band, dirname):
+        '''
+        @param band         Band (masked array) to store.
+        @param dirname      Directory of the files.
+        '''
+        self.shape = band.shape
+        self.dtype = band.dtype
+        self.dataFile = self._createFile(dirname, '.band', ma.getdata(band), self.dtype)
+        self.maskFile = self._createFile(dirname, '.mask', pack_mask(ma.getmaskarray(band)), np.uint8)
+        self.owner = True
+        self.pid = os.getpid()  # Forked processes inherit the band, but they don't own the files
+
+    def __del__(self):
+        if self.owner and self.pid == os.getpid():
+            self.remove()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['owner'] = False
+        return state
+
+    def _createFile(self, dirname, suffix, data, dtype):
+        handle, filename = tempfile.mkstemp(suffix=suffix, dir=dirname)
+        os.close(handle)
+        if data.size > 0:
+            m = np.memmap(filename, dtype=dtype, mode='w+', shape=data.shape)
+            m[...] = data
+            m.flush()
+        return filename
+
+    def getBand(self):
+        '''
+        Return the band as masked array, the data is memory-mapped (the changes of the data are written to the file).
+        The mask is unpacked into a copy: the changes of the mask are not stored, use setWindow to change the mask.
+        '''
+        return ma.array(data=self.getData(), mask=self.getMask(), copy=False)
+
+    def getData(self):
+        if np.prod(self.shape) == 0:
+            return np.zeros(self.shape, dtype=self.dtype)
+        return np.memmap(self.dataFile, dtype=self.dtype, mode='r+', shape=self.shape)
+
+    def getMask(self):
+        if np.prod(self.shape) == 0:
+            return np.zeros(self.shape, dtype=np.bool)
+        return unpack_mask(np.memmap(self.maskFile, dtype=np.uint8, mode='r'), self.shape)
+
+    def getWindow(self, row, col, height, width):
+        '''Return the window [row:row+height, col:col+width] of the band, only the rows of the window are unpacked from the mask.'''
+        rows, cols = self.shape
+        height, width = min(height, rows - row), min(width, cols - col)
+        data = self.getData()[row:row+height, col:col+width]
+        start, stop = row*cols, (row+height)*cols     # Bits of the rows
+        packed = np.memmap(self.maskFile, dtype=np.uint8, mode='r')[start/8: (stop+7)/8]
+        mask = unpack_mask(packed, ((stop+7)/8 - start/8)*8)[start%8: start%8 + stop-start]
+        mask = mask.reshape(height, cols)[:, col:col+width]
+        return ma.array(data=data, mask=mask, copy=False)
+
+    def setWindow(self, row, col, block):
+        '''Write the block (masked array) into the window of the band, (row, col) is the top left pixel of the window.'''
+        rows, cols = self.shape
+        height, width = block.shape
+        self.getData()[row:row+height, col:col+width] = ma.getdata(block)
+        start, stop = row*cols, (row+height)*cols     # Bits of the rows
+        first, last = start/8, (stop+7)/8             # Bytes of the rows
+        packed = np.memmap(self.maskFile, dtype=np.uint8, mode='r+')
+        bits = unpack_mask(packed[first:last], (last - first)*8)
+        mask = bits[start%8: start%8 + stop-start].reshape(height, cols)
+        mask[:, col:col+width] = ma.getmaskarray(block)
+        packed[first:last] = pack_mask(bits)
+        packed.flush()
+
+    def remove(self):
+        '''Remove the files of the band.'''
+        for filename in [self.dataFile, self.maskFile]:
+            try:
+                os.remove(filename)
+            except OSError:     # The file is absent or mapped (Windows)
+                pass
 
 
 class Raster(object):
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, lazy=False, scratch=None):
+        '''
+        @param filename     Name of the raster file.
+        @param lazy         Don't read the bands at once: keep the file opened and read the bands (or blocks of the bands) on demand.
+                            Only the users of getBlock and iterBlocks avoid reading of the whole bands, getBand reads the band entirely.
+        @param scratch      Directory for memory-mapped storage of the bands (see MappedBand). None means the bands are stored in RAM.
+        '''
         # TODO: Get mask values from the raster metadata.
         self.filename = filename
+        self.lazy     = lazy     # Read the bands from the file on demand
+        self.scratch  = scratch  # Directory of the memory-mapped bands
+        self.dataset  = None     # Opened GDAL dataset of the lazy raster
+        self.pid      = None     # Process that opened the dataset
         self.maskVals = None     # List of the "transparent" pixel values
         self.bands    = None     # List of the bands (stored as numpy mask array)
         self.geodata  = None     # Georeferensing information
         self.stat     = None     # Initial (before normalizing) statistic (means and stds) of the bands
+        self.statCache = {}      # Statistic of the bands {bandNo: stat} (see getBandStat), it is reset by setBand
         self.isNormalazed = None # Is the bands of the raster normalized? It contains the mode of normalization.
         if self.filename: self._read()
 
+    def __getstate__(self):
+        # GDAL dataset can't be pickled, it is reopened after unpickling
+        state = self.__dict__.copy()
+        state['dataset'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.lazy and self.filename:
+            self.dataset = gdal.Open(self.filename)
+            self.pid = os.getpid()
+
+    def _getDataset(self):
+        '''
+        Return GDAL dataset of the lazy raster. A forked process (a worker of parallel.imap for example) reopens
+        the dataset: the processes can't read the inherited dataset at once, they share the file offset and the driver state.
+        '''
+        if self.dataset is not None and self.pid != os.getpid():
+            self.dataset = gdal.Open(self.filename)
+            self.pid = os.getpid()
+        return self.dataset
+
     def binaryzation(self, trueVals, bandNum):
         '''Reclass band bandNum to true/false mode. Set true for pixels from trueVals.'''
         r = self.getBand(bandNum)
@@ -54,26 +313,26 @@ class Raster(object):
         self.setBand(r, bandNum)
 
     def create(self, bands, geodata):
-        self.bands = bands
+        self.statCache = {}
+        if self.scratch:
+            self.bands = [None]*len(bands)
+            for i, band in enumerate(bands):
+                self.setBand(band, i+1)
+        else:
+            self.bands = bands
         self.geodata = geodata
 
     def denormalize(self):
         '''
-        Denormalisation (see self.normalize)
+        Denormalisation (see self.normalize), the bands are changed in-place.
         '''
 
         if self.isNormalazed:
             mode = self.isNormalazed
             bandcount = self.getBandsCount()
             for i in range(1, bandcount+1):
-                stat = self.stat[i-1]
-                if mode == 'mean':
-                    newBand = 1.0*self.getBand(i)*stat['std'] + stat['mean']
-                elif mode == 'maxmin':
-                    newBand = 1.0*self.getBand(i)*(stat['max'] - stat['min']) - stat['min']
-                else:
-                    raise ProviderError('The normalization mode is unknown!')
-                self.setBand(newBand, i)
+                offset, scale = self._normParams(mode, self.stat[i-1])
+                self._transform(i, scale, offset, 1.0)
             self.isNormalazed = False
 
     def geoDataMatch(self, raster):
@@ -115,7 +374,60 @@ class Raster(object):
         return True
 
     def getBand(self, bandNo):
-        return self.bands[bandNo-1]
+        '''
+        Return the band as masked array. The array must be treated as read-only: the statistic of the band
+        is cached (see getBandStat) and isn't updated by in-place changes of the array, change the band via setBand or setBlock.
+        '''
+        band = self.bands[bandNo-1]
+        if band is None and self.dataset is not None:
+            # The band of the lazy raster is read at the first request, the band values (and statistic) are the same
+            stat = self.statCache.get(bandNo)
+            self.setBand(self.getBlock(bandNo, 0, 0, self.getYSize(), self.getXSize()), bandNo)
+            if stat is not None:
+                self.statCache[bandNo] = stat
+            band = self.bands[bandNo-1]
+        if isinstance(band, MappedBand):
+            return band.getBand()
+        return band
+
+    def getBlock(self, bandNo, row, col, height, width):
+        '''
+        Return the window [row:row+height, col:col+width] of the band as masked array.
+        The band of the lazy raster isn't read entirely: only the window is read from the file.
+        '''
+        band = self.bands[bandNo-1]
+        if band is None and self.dataset is not None:
+            r = self._readBand(self._getDataset(), bandNo, row, col, height, width)
+            return ma.array(data = r, mask=ma.getmaskarray(r))
+        if isinstance(band, MappedBand):
+            return band.getWindow(row, col, height, width)
+        return band[row:row+height, col:col+width]
+
+    def setBlock(self, bandNo, row, col, block):
+        '''
+        Write the block (masked array) into the window of the band, (row, col) is the top left pixel of the window.
+        The changes of the data and the mask are stored for memory-mapped bands too.
+        '''
+        band = self.bands[bandNo-1]
+        if band is None and self.dataset is not None:
+            self.getBand(bandNo)
+            band = self.bands[bandNo-1]
+        self.statCache.pop(bandNo, None)
+        if isinstance(band, MappedBand):
+            band.setWindow(row, col, block)
+        else:
+            height, width = block.shape
+            band[row:row+height, col:col+width] = block
+
+    def getBlockSize(self):
+        '''
+        Return size (xSize, ySize) of the native blocks of the raster file.
+        The bands of in-memory rasters are splitted into blocks of one row.
+        '''
+        if self.dataset is not None:
+            xBlock, yBlock = self._getDataset().GetRasterBand(1).GetBlockSize()
+            return xBlock, yBlock
+        return self.getXSize(), 1
 
     def getBandsCount(self):
         if self.bands != None:
@@ -123,24 +435,78 @@ class Raster(object):
         else:
             return 0
 
-    def getBandStat(self, bandNo):
+    def getBandStat(self, bandNo, gradation=True, maxGradations=None):
         '''
-        Return mean and std of the raster's band
+        Return mean, std, min, max and gradation (list of unique values) of the raster's band.
+        The statistic is computed in one pass over the blocks of the band (see iterBlocks)
+        and cached until the band is changed by setBand or setBlock (the arrays returned by getBand are read-only).
+
+        @param gradation        Compute the gradation of the band.
+        @param maxGradations    Maximal length of the gradation. If the band has more unique values
+                                    (a continuous band for example), the gradation is None.
         '''
-        band = self.getBand(bandNo)
+        stat = self.statCache.get(bandNo)
+        if stat is None or (gradation and not stat.has_key('gradation')):
+            stat = self._computeStat(bandNo, gradation, maxGradations)
+            cached = dict(stat)
+            if gradation and stat['gradation'] is None:
+                del cached['gradation']     # Incomplete gradation isn't cached
+            self.statCache[bandNo] = cached
+        result = dict(stat)
+        if not gradation:
+            result.pop('gradation', None)
+        elif maxGradations is not None and result['gradation'] is not None and len(result['gradation']) > maxGradations:
+            result['gradation'] = None
+        return result
+
+    def _computeStat(self, bandNo, gradation=True, maxGradations=None):
+        '''
+        One-pass computation of the band statistic (see getBandStat).
+        Means and sums of squared deviations of the blocks are combined by Chan's formula.
+        '''
+        count, mean, M2 = 0, 0.0, 0.0       # Count of unmasked pixels, mean and sum of squared deviations
+        minValue = maxValue = None
+        grad = None
+        for row, col, [block] in self.iterBlocks(bandNo):
+            x = ma.asarray(block).compressed()
+            n = len(x)
+            if n == 0:
+                continue
+            blockMean = x.mean(dtype=np.float64)
+            blockM2 = np.square(x - blockMean).sum()
+            delta = blockMean - mean
+            mean = mean + delta*n/(count + n)
+            M2 = M2 + blockM2 + delta**2 * count*n/(count + n)
+            count = count + n
+
+            blockMin, blockMax = x.min(), x.max()
+            minValue = blockMin if minValue is None else min(minValue, blockMin)
+            maxValue = blockMax if maxValue is None else max(maxValue, blockMax)
+
+            if gradation:
+                grad = np.unique(x) if grad is None else np.union1d(grad, x)
+                if maxGradations is not None and len(grad) > maxGradations:
+                    gradation = False
+                    grad = None
+
         result = {}
-        result['mean'] = np.mean(band)
-        result['std']  = np.std (band)
-        result['min']  = np.min (band)
-        result['max']  = np.max (band)
-        result['gradation'] = get_gradations(band.compressed())
+        if count > 0:
+            result['mean'] = mean
+            result['std']  = np.sqrt(M2/count)
+            result['min']  = minValue
+            result['max']  = maxValue
+        else:
+            result['mean'] = result['std'] = result['min'] = result['max'] = ma.masked
+        if gradation:
+            result['gradation'] = list(grad) if grad is not None else []
+        else:
+            result['gradation'] = None
         return result
 
 
     def get_dtype(self):
-        # All bands of the raster have the same dtype now
-        band = self.getBand(1)
-        return band.dtype
+        # All bands of the raster have the same dtype now, the dtype is taken from one pixel (the band isn't read)
+        return self.getBlock(1, 0, 0, 1, 1).dtype
 
     def getFileName(self):
         return self.filename
@@ -183,39 +549,101 @@ class Raster(object):
     def getYSize(self):
         return self.geodata['ySize']
 
+    def iterBlocks(self, bandNo=None, pixels=CHUNK_SIZE):
+        '''
+        Iterate over the windows of the raster. The windows consist of whole native blocks (see getBlockSize)
+        and contain about 'pixels' pixels (but not less then one block).
+        @param bandNo       Number of the band to read, None means all bands.
+        @param pixels       Desired pixel count of the windows.
+        @return             Generator of (row, col, blocks) tuples, where (row, col) is the top left pixel of the window,
+                                blocks is list of the windows of the bands (masked arrays).
+        '''
+        rows, cols = self.getYSize(), self.getXSize()
+        xBlock, yBlock = self.getBlockSize()
+        width = min(xBlock, cols)
+        height = min(rows, yBlock * max(1, pixels/(width*yBlock)))
+        if bandNo:
+            bandNums = [bandNo]
+        else:
+            bandNums = range(1, self.getBandsCount()+1)
+        for row in xrange(0, rows, height):
+            for col in xrange(0, cols, width):
+                h, w = min(height, rows - row), min(width, cols - col)
+                yield row, col, [self.getBlock(i, row, col, h, w) for i in bandNums]
+
     def isMetricProj(self):
         '''
         Return true if projection of the raster uses metric units
         '''
         return self.getProjUnits() in ('metre', 'Meter')
 
-    def normalize(self, mode='mean'):
+    def normalize(self, mode='mean', dtype=None):
         '''
         Linear normalization of the bands: new = (old-mean(old)/std(old))
+        The initial bands are copied once (the arrays can be shared with other objects), then the bands are changed in-place:
+        statistic of the initial bands is stored, so switching of the modes is one pass over the bands without copying.
 
         @param mode     Type of normalization:
                 mean    new = (old-mean(old)/std(old))
                 maxmin  new = (old-min(old)/(max(old)-min(old))
+        @param dtype    Float dtype of the normalized bands (np.float32 halves the memory). None keeps the float dtype
+                        of the bands (integer bands are converted to np.float64), so the switching of the modes keeps the dtype.
         '''
-
-
+        if mode not in ['mean', 'maxmin']:
+            raise ProviderError('The normalization mode is unknown!')
 
         if self.isNormalazed != mode:
-            self.denormalize()          # Reset raster values to initail
             bandcount = self.getBandsCount()
-            self.stat = []
+            copy = not self.isNormalazed
+            if copy:
+                self.stat = [self.getBandStat(i, gradation=False) for i in range(1, bandcount+1)]
             for i in range(1, bandcount+1):
-                stat = self.getBandStat(i)
-                self.stat.append(stat)
-                if mode == 'mean':
-                    newBand = 1.0*(self.getBand(i) - stat['mean'])/stat['std']
-                elif mode == 'maxmin':
-                    newBand = 1.0*(self.getBand(i) - stat['min'])/(stat['max'] - stat['min'])
-                else:
-                    raise ProviderError('The normalization mode is unknown!')
-                self.setBand(newBand, i)
+                # new = (initial - offset)/scale, initial = current*currScale + currOffset
+                currOffset, currScale = self._normParams(self.isNormalazed, self.stat[i-1])
+                offset, scale = self._normParams(mode, self.stat[i-1])
+                self._transform(i, currScale, currOffset - offset, scale, dtype, copy)
             self.isNormalazed = mode
 
+    def _normParams(self, mode, stat):
+        '''
+        Return (offset, scale) of the normalization: normalized = (initial - offset)/scale.
+        '''
+        if not mode:
+            return 0.0, 1.0
+        if mode == 'mean':
+            offset, scale = stat['mean'], stat['std']
+        elif mode == 'maxmin':
+            offset, scale = stat['min'], stat['max'] - stat['min']
+        else:
+            raise ProviderError('The normalization mode is unknown!')
+        if not scale:   # Constant band
+            scale = 1.0
+        return 1.0*offset, 1.0*scale
+
+    def _transform(self, bandNo, mul, shift, div, dtype=None, copy=False):
+        '''
+        In-place affine transform of the band: new = (old*mul + shift)/div.
+        The band is copied if copy is True or it has to be converted to dtype (or to float64 for integer bands).
+        '''
+        band = self.getBand(bandNo)
+        if dtype is None and band.dtype.kind != 'f':
+            dtype = np.float64
+        copied = copy or (dtype is not None and band.dtype != dtype)
+        if copied:
+            band = ma.array(band, dtype=dtype, copy=True)
+        data = ma.getdata(band)
+        if mul != 1:
+            data *= mul
+        if shift != 0:
+            data += shift
+        if div != 1:
+            data /= div
+        if copied or not isinstance(self.bands[bandNo-1], MappedBand):
+            self.setBand(band, bandNo)
+        else:
+            # The data of the mapped band is changed in the file
+            self.statCache.pop(bandNo, None)
+
     def _read(self):
         data = gdal.Open( self.filename )
         if data is None:
@@ -232,18 +660,48 @@ class Raster(object):
         sr.ImportFromWkt(self.geodata['proj'])
         self.geodata['units'] = sr.GetLinearUnitsName()
 
-        self.bands = []
-        for i in range(1, data.RasterCount+1):
-            r = data.GetRasterBand(i)
-            nodataValue =  r.GetNoDataValue()
-            r = r.ReadAsArray()
-            if nodataValue:
-                mask = binaryzation(r, [nodataValue])
-                r = ma.array(data = r, mask=mask)
-            self.bands.append(r)
-        self.resetMask()
+        if self.lazy:
+            # The bands are read on demand (see getBand and getBlock)
+            self.dataset = data
+            self.pid = os.getpid()
+            self.bands = [None]*data.RasterCount
+        else:
+            self.bands = [None]*data.RasterCount
+            mask = None
+            for i in range(1, data.RasterCount+1):
+                band = self._readBand(data, i, mask=mask)
+                if data.GetRasterBand(i).GetMaskFlags() & gdal.GMF_PER_DATASET:
+                    # All bands share the mask array of the dataset (masking of a pixel in one band masks it in all bands)
+                    mask = band.mask
+                self.setBand(band, i)
         self.isNormalazed = False
 
+    def _readBand(self, data, bandNo, row=0, col=0, height=None, width=None, mask=None):
+        '''
+        Read the window of the band from GDAL dataset as masked array.
+        The mask is built from GDAL mask flags: pixels equal to NoData value are masked,
+        the mask band (per-dataset mask, alpha band) is read together with the data.
+        @param mask     Mask of the window shared by all bands of the dataset (it isn't read again if it is known).
+        '''
+        if height is None: height = data.RasterYSize - row
+        if width  is None: width  = data.RasterXSize - col
+        band = data.GetRasterBand(bandNo)
+        r = band.ReadAsArray(col, row, width, height)
+        if mask is not None:
+            return ma.array(data = r, mask = mask, copy=False)
+
+        flags = band.GetMaskFlags()
+        if flags & gdal.GMF_ALL_VALID:
+            mask = np.zeros(r.shape, dtype=np.bool)
+        elif flags & gdal.GMF_NODATA:
+            nodataValue = band.GetNoDataValue()
+            if np.isnan(nodataValue):
+                mask = np.isnan(r)
+            else:
+                mask = (r == nodataValue)
+        else:
+            mask = band.GetMaskBand().ReadAsArray(col, row, width, height) == 0
+        return ma.array(data = r, mask = mask)
 
     def resetMask(self, maskVals = None):
         '''
@@ -261,44 +719,51 @@ class Raster(object):
         '''Reclass band bandNum to new categories.
         @param bins     List of bins (category bounds):
                 Interval         ->   New Class Number
-                [bin[0], bin[1]) ->     1
-                [bin[1], bin[2]) ->     2
+                (-Inf,   bin[0]) ->     1
+                [bin[0], bin[1]) ->     2
                 ...
                 [bin[n-1], bin[n]) ->   n
+                [bin[n],      Inf) ->   n+1
         '''
         tmp = bins[:]
         tmp.sort()
-        if x!=tmp:
+        if bins!=tmp:
             raise ProviderError('Reclassification error: bins must be sorted!')
 
         r = self.getBand(bandNum)
         r = reclass(r, bins)
         self.setBand(r, bandNum)
 
-    def save(self, filename, format="GTiff", rastertype=None, nodata=0):
-        driver = gdal.GetDriverByName(format)
-        metadata = driver.GetMetadata()
-        if metadata.has_key(gdal.DCAP_CREATE) and metadata[gdal.DCAP_CREATE] == "YES":
-            if not rastertype:
-                dtype = self.get_dtype()
-                conv = FormatConverter()
-                rastertype = conv.dtype2GDT[dtype]
-            xsize, ysize = self.getXSize(), self.getYSize()
-            bandcount = self.getBandsCount()
-            outRaster = driver.Create(filename, xsize, ysize, bandcount, rastertype)
-            geodata = self.getGeodata()
-            outRaster.SetProjection(geodata['proj'])
-            outRaster.SetGeoTransform(geodata['transform'])
-            for i in range(bandcount):
-                band = self.getBand(i+1)
-                outRaster.GetRasterBand( i + 1 ).WriteArray(band.filled(fill_value=nodata))
-                outRaster.GetRasterBand( i + 1 ).SetNoDataValue(nodata)
-            outRaster = None
-        else:
-          raise ProviderError("Driver %s does not support Create() method!" % format)
+    def save(self, filename, format="GTiff", rastertype=None, nodata=0, options=None):
+        '''
+        Save the raster block by block (see RasterWriter), reading and writing of the blocks are overlapped (see parallel.prefetch).
+        @param options      List of the creation options of the driver (see RasterWriter.gtiffOptions).
+        '''
+        if not rastertype:
+            dtype = self.get_dtype()
+            conv = FormatConverter()
+            minValue = maxValue = None
+            if dtype not in conv.dtype2GDT:
+                # The type is chosen by the range of the values (and nodata value)
+                minValue = maxValue = nodata
+                for i in range(1, self.getBandsCount()+1):
+                    band = ma.asarray(self.getBand(i))
+                    if band.count() > 0:
+                        minValue, maxValue = min(minValue, band.min()), max(maxValue, band.max())
+            rastertype = conv.getRasterType(dtype, minValue, maxValue)
+        # The next blocks are read and the previous blocks are written while the current block is processed
+        writer = ThreadedWriter(RasterWriter(filename, self.getGeodata(), self.getBandsCount(), rastertype, format, nodata, options))
+        try:
+            writer.writeBlocks(prefetch(self.iterBlocks()))
+        finally:
+            writer.close()
 
 
     def setBand(self, raster, bandNum=1):
+        self.statCache.pop((bandNum-1) % len(self.bands) + 1, None)    # bandNum=0 is the last band (see resetMask)
+        if self.scratch:
+            # The previous files of the band are removed when they aren't used
+            raster = MappedBand(raster, self.scratch)
         self.bands[bandNum-1] = raster
 
     def setGeoData(self, geodata):
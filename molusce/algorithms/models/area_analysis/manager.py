@@ -6,7 +6,7 @@ from numpy import ma as ma
 from PyQt4.QtCore import *
 
 from molusce.algorithms.dataprovider import Raster
-from molusce.algorithms.utils import masks_identity
+from molusce.algorithms.utils import class_dtype, masks_identity, CHUNK_SIZE
 
 
 class AreaAnalizerError(Exception):
@@ -48,8 +48,7 @@ class AreaAnalyst(QObject):
         self.classes = statFirst['gradation']
         self.classesSecond = statSecong['gradation']
 
-        first, second = masks_identity(first.getBand(1), second.getBand(1))
-
+        # The rasters are read by blocks during creation of the change map
         self.first = first
         self.second = second
 
@@ -92,6 +91,21 @@ class AreaAnalyst(QObject):
         m = len(self.classes)
         return self.classes.index(initialClass) * m + self.classes.index(finalClass)
 
+    def encodeArrays(self, initial, final):
+        '''
+        Encode transitions (initialClass -> finalClass) of the arrays of classes (see 'encode').
+        Elements that are not in the list of classes get meaningless codes (mask them).
+        '''
+        m = len(self.classes)
+        classes = np.array(self.classes)
+        initialIndex = np.searchsorted(classes, ma.getdata(initial))
+        finalIndex   = np.searchsorted(classes, ma.getdata(final))
+        np.clip(initialIndex, 0, m-1, initialIndex)
+        np.clip(finalIndex, 0, m-1, finalIndex)
+        initialIndex *= m
+        initialIndex += finalIndex
+        return initialIndex
+
     def finalCodes(self, initialClass):
         '''
         For given initial class return codes of possible final classes. (see 'encode')
@@ -106,16 +120,20 @@ class AreaAnalyst(QObject):
     def makeChangeMap(self):
         f, s = self.first, self.second
         rows, cols = self.geodata['ySize'], self.geodata['xSize']
-        band = np.zeros([rows, cols])
-        self.rangeChanged.emit(self.tr("Creating change map %p%"), rows)
-        for i in xrange(rows):
-            for j in xrange(cols):
-                if not f.mask[i,j]:
-                    r = f[i,j]
-                    c = s[i,j]
-                    band[i, j] = self.encode(r, c)
+        m = len(self.classes)
+        band = np.zeros([rows, cols], dtype=class_dtype([m*m - 1]))     # Codes are 0, 1, ..., m*m-1
+        mask = np.zeros([rows, cols], dtype=np.bool)
+        blockRows = max(1, CHUNK_SIZE/cols)     # The map is created by blocks of rows
+        self.rangeChanged.emit(self.tr("Creating change map %p%"), (rows + blockRows - 1)/blockRows)
+        for i in xrange(0, rows, blockRows):
+            height = min(blockRows, rows - i)
+            first, second = masks_identity(f.getBlock(1, i, 0, height, cols), s.getBlock(1, i, 0, height, cols))
+            block = band[i:i+height]
+            block[...] = self.encodeArrays(first, second)
+            mask[i:i+height] = ma.getmaskarray(first)
+            block[mask[i:i+height]] = 0
             self.updateProgress.emit()
-        bands = [np.ma.array(data = band, mask = f.mask)]
+        bands = [np.ma.array(data = band, mask = mask)]
         raster = Raster()
         raster.create(bands, self.geodata)
         self.processFinished.emit(raster)
@@ -3,6 +3,7 @@
 
 import numpy as np
 
+from molusce.algorithms.parallel import prefetch
 from molusce.algorithms.models.crosstabs.model  import CrossTable
 
 class CrossTabManagerError(Exception):
@@ -24,7 +25,19 @@ class CrossTableManager(object):
 
         self.pixelArea = initRaster.getPixelArea()
 
-        self.crosstable = CrossTable(initRaster.getBand(1), finalRaster.getBand(1))
+        # The crosstable is accumulated block by block, so the bands of lazy rasters aren't read entirely.
+        # The next blocks are read while the current blocks are counted.
+        def blocks():
+            for row, col, [initBlock] in initRaster.iterBlocks(1):
+                height, width = initBlock.shape
+                yield initBlock, finalRaster.getBlock(1, row, col, height, width)
+
+        self.crosstable = None
+        for initBlock, finalBlock in prefetch(blocks()):
+            if self.crosstable is None:
+                self.crosstable = CrossTable(initBlock, finalBlock)
+            else:
+                self.crosstable.update(initBlock, finalBlock)
 
     def getCrosstable(self):
         return self.crosstable
@@ -3,7 +3,7 @@
 
 import numpy as np
 
-from molusce.algorithms.utils import masks_identity, sizes_equal, get_gradations
+from molusce.algorithms.utils import masks_identity, sizes_equal
 
 class CrossTabError(Exception):
     '''Base class for exceptions in this module.'''
@@ -11,10 +11,33 @@ class CrossTabError(Exception):
         self.msg = msg
 
 
+def _table_dtype(n):
+    '''Return compact integer dtype for the table of n elements'''
+    if n <= np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
 class CrossTable(object):
-    '''Class for compute gradations, contingency (cross)table T'''
+    '''Class for compute gradations, contingency (cross)table T
+
+    The table can be accumulated by blocks: create the table using the first blocks of the bands,
+    then add the next blocks via update method. So crosstable of big rasters can be computed block by block.
+    '''
     def __init__(self, band1, band2):
 
+        self.graduation_x = []
+        self.graduation_y = []
+        self.shape = (0, 0)
+        self.T = np.zeros(self.shape, dtype=np.int32)
+        self.n = 0                      # Count of unmasked elements  (= sum of all elements of the table)
+
+        self.update(band1, band2)
+
+    def update(self, band1, band2):
+        '''
+        Add transitions between band1 and band2 to the crosstable.
+        '''
         if not sizes_equal(band1, band2):
             raise CrossTabError('Sizes of rasters are not equal!')
 
@@ -23,20 +46,31 @@ class CrossTable(object):
         X = np.ma.compressed(band1)
         Y = np.ma.compressed(band2)
 
-        # Compute gradations of the bands
-        self.graduation_x = get_gradations(X)
-        self.graduation_y = get_gradations(Y)
-
-        rows, cols = len(self.graduation_x), len(self.graduation_y)
-        self.shape = (rows, cols)
-
-        # Compute crosstable
-        self.T = np.zeros([rows, cols], dtype=int)
-        self.n = len(X)                 # Count of unmasked elements  (= sum of all elements of the table)
-        for i in range(self.n):
-            class_num_x = self.graduation_x.index(X[i])
-            class_num_y = self.graduation_y.index(Y[i])
-            self.T[class_num_x][class_num_y] +=1
+        # Compute gradations of the bands and class numbers of the pixels
+        block_x, X = np.unique(X, return_inverse=True)
+        block_y, Y = np.unique(Y, return_inverse=True)
+        rows, cols = len(block_x), len(block_y)
+
+        # Compute crosstable of the bands in one pass
+        T = np.bincount(np.ravel_multi_index((X, Y), (rows, cols)), minlength=rows*cols)
+        T.shape = (rows, cols)
+
+        # Merge gradations and crosstables
+        graduation_x = np.union1d(self.graduation_x, block_x) if self.n > 0 else block_x
+        graduation_y = np.union1d(self.graduation_y, block_y) if self.n > 0 else block_y
+        n = self.n + len(X)
+        table = np.zeros((len(graduation_x), len(graduation_y)), dtype=_table_dtype(n))
+        for tab, grad_x, grad_y in [(self.T, self.graduation_x, self.graduation_y), (T, block_x, block_y)]:
+            if tab.size > 0:
+                ind_x = np.searchsorted(graduation_x, grad_x)
+                ind_y = np.searchsorted(graduation_y, grad_y)
+                table[np.ix_(ind_x, ind_y)] += tab
+
+        self.graduation_x = list(graduation_x)
+        self.graduation_y = list(graduation_y)
+        self.shape = table.shape
+        self.T = table
+        self.n = n
 
     def getCrosstable(self):
         return self.T
@@ -6,10 +6,15 @@
 
 
 
+from functools import partial
+
 import numpy as np
+from numpy import ma as ma
 
-from molusce.algorithms.dataprovider import Raster, ProviderError
+from molusce.algorithms.dataprovider import Raster, RastersWriter, ProviderError
 from molusce.algorithms.models.sampler.sampler import Sampler
+from molusce.algorithms.utils import class_dtype, CHUNK_SIZE, CONFIDENCE_DTYPE
+from molusce.algorithms.parallel import predict_blocks
 
 
 class LRError(Exception):
@@ -23,7 +28,7 @@ class LR(object):
     (maximum liklihood parameter estimation).
     """
 
-    def __init__(self, ns=0, logreg=None):
+    def __init__(self, ns=0, logreg=None, processes=1):
 
         from sklearn import linear_model as lm
 
@@ -34,6 +39,7 @@ class LR(object):
             self.logreg = lm.LogisticRegression()
 
         self.ns = ns            # Neighbourhood size of training rasters.
+        self.processes = processes  # Count of processes used for prediction (see parallel.imap)
         self.data = None        # Training data
         self.classlist = None   # List of unique output values of the output raster
 
@@ -55,14 +61,14 @@ class LR(object):
         self._predict(state, factors)
         return self.prediction
 
-    def _outputConfidence(self, input):
+    def _outputConfidence(self, proba):
         '''
         Return confidence (difference between 2 biggest probabilities) of the LR output.
+        @param proba    Matrix of the class probabilities (one row per sample).
         '''
-        out_scl = self.logreg.predict_proba(input)[0]
         # Calculate the confidence:
-        out_scl.sort()
-        return out_scl[-1] - out_scl[-2]
+        out_scl = np.sort(proba, axis=-1)
+        return out_scl[..., -1] - out_scl[..., -2]
 
     def _predict(self, state, factors):
         '''
@@ -80,29 +86,75 @@ class LR(object):
         for f in factors:
             f.normalize(mode = 'mean')
 
-        predicted_band  = np.zeros([rows, cols])
-        confidence_band = np.zeros([rows, cols])
+        # Predict by blocks of rows, every block contains about CHUNK_SIZE input values
+        sampler = Sampler(state, factors, ns=self.ns)
+        blockRows = max(1, CHUNK_SIZE/(cols*(sampler.stateVecLen + sampler.factorVectLen)))
+        writer = RastersWriter(geodata, [class_dtype(self.logreg.classes_), CONFIDENCE_DTYPE])
+        predict_blocks(
+            partial(self._readBlock, sampler, state, factors), self._predictBlock,
+            writer, rows, blockRows, self.processes
+        )
+        self.prediction, self.confidence = writer.rasters
+
+    def _readBlock(self, sampler, state, factors, first, last):
+        '''
+        Read the input samples of rows first, ..., last-1 (see parallel.predict_blocks).
+        @return (samples, valid)    Matrix of the complete samples and the mask of the pixels that have the complete samples.
+        '''
+        inputs, valid = sampler.get_inputs_block(state, factors, first, last)
+        valid = valid & ~ma.getmaskarray(state.getBlock(1, first, 0, last - first, state.getXSize()))
+        return inputs[valid.flatten()], valid
+
+    def _predictBlock(self, inputs):
+        '''
+        Predict the pixels of a block from its input samples (see _readBlock and parallel.predict_blocks).
+        '''
+        samples, valid = inputs
+        predicted  = np.zeros(valid.shape, dtype=class_dtype(self.logreg.classes_))
+        confidence = np.zeros(valid.shape, dtype=CONFIDENCE_DTYPE)
+        if valid.any():
+            proba = self.logreg.predict_proba(samples)
+            # The class and the confidence are derived from the same probabilities
+            predicted[valid]  = self.logreg.classes_[np.argmax(proba, axis=1)]
+            confidence[valid] = self._outputConfidence(proba)
+        return [predicted, confidence], ~valid   # Input sample is incomplete => mask this pixel
+
+    def updatePrediction(self, state, factors, dirty):
+        '''
+        Recalculate the prediction and the confidence of the dirty pixels only, the other pixels are kept.
+        The state must differ from the state of the last prediction only in the dirty pixels
+        and must have the same mask, the factors must be the same.
+        @param state            Raster of the current state (classes) values.
+        @param factors          List of the factor rasters (predicting variables).
+        @param dirty            Boolean array of the raster shape, it is True where the prediction has to be recalculated.
+        @return                 Raster of the prediction.
+        '''
+        if self.prediction is None:
+            return self.getPrediction(state, factors)
+        for f in factors:
+            f.normalize(mode = 'mean')
 
+        # The blocks of rows that contain dirty pixels are recalculated and written back
+        rows, cols = state.getYSize(), state.getXSize()
         sampler = Sampler(state, factors, ns=self.ns)
-        mask = state.getBand(1).mask.copy()
-        for i in xrange(rows):
-            for j in xrange(cols):
-                if not mask[i,j]:
-                    input = sampler.get_inputs(state, factors, i,j)
-                    if input != None:
-                        out = self.logreg.predict(input)
-                        predicted_band[i,j] = out
-                        confidence = self._outputConfidence(input)
-                        confidence_band[i, j] = confidence
-                    else: # Input sample is incomplete => mask this pixel
-                        mask[i, j] = True
-        predicted_bands  = [np.ma.array(data = predicted_band, mask = mask)]
-        confidence_bands = [np.ma.array(data = confidence_band, mask = mask)]
-
-        self.prediction = Raster()
-        self.prediction.create(predicted_bands, geodata)
-        self.confidence = Raster()
-        self.confidence.create(confidence_bands, geodata)
+        blockRows = max(1, CHUNK_SIZE/(cols*(sampler.stateVecLen + sampler.factorVectLen)))
+        for first in xrange(0, rows, blockRows):
+            last = min(first + blockRows, rows)
+            if not dirty[first:last].any():
+                continue
+            predicted  = self.prediction.getBlock(1, first, 0, last - first, cols).copy()
+            confidence = self.confidence.getBlock(1, first, 0, last - first, cols).copy()
+            # The masks don't depend on the state values, so masked pixels stay masked
+            r, c = np.nonzero(dirty[first:last] & ~ma.getmaskarray(predicted))
+            if len(r) == 0:
+                continue
+            inputs = sampler.get_inputs_at(state, factors, r + first, c)
+            proba = self.logreg.predict_proba(inputs)
+            ma.getdata(predicted)[r, c]  = self.logreg.classes_[np.argmax(proba, axis=1)]
+            ma.getdata(confidence)[r, c] = self._outputConfidence(proba)
+            self.prediction.setBlock(1, first, 0, predicted)
+            self.confidence.setBlock(1, first, 0, confidence)
+        return self.prediction
 
     def read(self):
         pass
@@ -110,7 +162,7 @@ class LR(object):
     def save(self):
         pass
 
-    def setTrainingData(self, state, factors, output, mode='All', samples=None):
+    def setTrainingData(self, state, factors, output, mode='All', samples=None, seed=None):
         '''
         @param state            Raster of the current state (classes) values.
         @param factors          List of the factor rasters (predicting variables).
@@ -120,6 +172,7 @@ class LR(object):
                                     Normal          Get samples. Count of samples in the data=samples.
                                     Balanced        Undersampling of major classes and/or oversampling of minor classes.
         @samples                Sample count of the training data (doesn't used in 'All' mode).
+        @param seed             Seed of the random generator used by the sampler.
         '''
         if not self.logreg:
             raise LRError('You must create a Logistic Regression model before!')
@@ -129,7 +182,7 @@ class LR(object):
             f.normalize(mode = 'mean')
 
         sampler = Sampler(state, factors, output, ns=self.ns)
-        sampler.setTrainingData(state, factors, output, shuffle=False, mode=mode, samples=samples)
+        sampler.setTrainingData(state, factors, output, shuffle=False, mode=mode, samples=samples, seed=seed)
 
         outputVecLen  = sampler.outputVecLen
         stateVecLen   = sampler.stateVecLen
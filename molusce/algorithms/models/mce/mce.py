@@ -4,10 +4,14 @@
 # TODO: make abstract class for all models/managers
 # to prevent code coping of common methods (for example _predict method)
 
+from functools import partial
+
 import numpy as np
+from numpy import ma as ma
 
-from molusce.algorithms.dataprovider import Raster, ProviderError
-from molusce.algorithms.utils import binaryzation
+from molusce.algorithms.dataprovider import Raster, RastersWriter, ProviderError
+from molusce.algorithms.utils import binaryzation, class_dtype, CHUNK_SIZE, CONFIDENCE_DTYPE
+from molusce.algorithms.parallel import predict_blocks
 
 class MCEError(Exception):
     '''Base class for exceptions in this module.'''
@@ -57,13 +61,14 @@ class MCE(object):
         38: 1.70,
         39: 1.70
     }
-    def __init__(self, factors, wMatr, initStateNum, finalStateNum):
+    def __init__(self, factors, wMatr, initStateNum, finalStateNum, processes=1):
         '''
         Multicriteria evaluation based on Saaty method. It defines transition probability of two classes (initStateNum, finalStateNum).
         @param factors          List of the factor rasters used for prediction.
         @param wMatr            List of lists -- NxN comparison matrix.
         @param initStateNum     Number of initial state (the state before transition).
         @param finalStateNum    Number of final state (the state after transition).
+        @param processes        Count of processes used for prediction (see parallel.imap).
         '''
 
         self.factors = factors
@@ -101,6 +106,7 @@ class MCE(object):
 
         self.prediction = None
         self.confidence = None
+        self.processes = processes
 
 
     def getConsistency(self):
@@ -118,8 +124,35 @@ class MCE(object):
         self._predict(state)
         return self.prediction
 
+    def updatePrediction(self, state, factors, dirty):
+        '''
+        Recalculate the prediction and the confidence of the blocks of rows that contain dirty pixels only,
+        the other blocks are kept. The prediction of a pixel depends on the pixel only (ns=0), so the recalculated
+        blocks are the same as the blocks of the full prediction.
+        @param state            Raster of the current state (classes) values.
+        @param factors          List of the factor rasters (they aren't used, MCE uses the factors of the initialization).
+        @param dirty            Boolean array of the raster shape, it is True where the prediction has to be recalculated.
+        @return                 Raster of the prediction.
+        '''
+        if self.prediction is None:
+            return self.getPrediction(state, factors)
+        for f in self.factors:
+            f.normalize(mode = 'maxmin')
+
+        rows, cols = state.getYSize(), state.getXSize()
+        dtype = self.prediction.get_dtype()
+        blockRows = max(1, CHUNK_SIZE/(cols*max(1, self.dim)))
+        for first in xrange(0, rows, blockRows):
+            last = min(first + blockRows, rows)
+            if not dirty[first:last].any():
+                continue
+            bands, mask = self._predictBlock(dtype, self._readBlock(state, first, last))
+            self.prediction.setBlock(1, first, 0, ma.array(data=bands[0], mask=mask))
+            self.confidence.setBlock(1, first, 0, ma.array(data=bands[1], mask=mask))
+        return self.prediction
+
     def getWeights(self):
-        if self.weights == None:
+        if self.weights is None:
             self.setWeights()
         return self.weights
 
@@ -130,10 +163,38 @@ class MCE(object):
         geodata = state.getGeodata()
         rows, cols = geodata['ySize'], geodata['xSize']
 
+        for f in self.factors:
+            if not f.geoDataMatch(state):
+                raise MCEError('Geometries of the state and factor rasters are different!')
+            f.normalize(mode = 'maxmin')
+        self.getWeights()   # The weights are calculated before the blocks are predicted
+        dtype = class_dtype(state.getBandStat(1)['gradation'] + [self.finalStateNum])
+
+        # Predict by blocks of rows, every block contains about CHUNK_SIZE factor values
+        blockRows = max(1, CHUNK_SIZE/(cols*max(1, self.dim)))
+        writer = RastersWriter(geodata, [dtype, CONFIDENCE_DTYPE])
+        predict_blocks(
+            partial(self._readBlock, state), partial(self._predictBlock, dtype),
+            writer, rows, blockRows, self.processes
+        )
+        self.prediction, self.confidence = writer.rasters
+
+    def _readBlock(self, state, first, last):
+        '''
+        Read the state and the factor bands of rows first, ..., last-1 (see parallel.predict_blocks).
+        '''
+        cols = state.getXSize()
+        factors = [f.getBlock(i+1, first, 0, last - first, cols) for f in self.factors for i in xrange(f.getBandsCount())]
+        return state.getBlock(1, first, 0, last - first, cols), factors
+
+    def _predictBlock(self, dtype, inputs):
+        '''
+        Predict the pixels of a block from the blocks of the state and the factors (see _readBlock and parallel.predict_blocks).
+        '''
+        band, factors = inputs
         # Get locations where self.initStateNum is occurs
-        band = state.getBand(1)
         initStateMask = binaryzation(band, [self.initStateNum])
-        mask = band.mask
+        mask = ma.getmaskarray(band)
 
         # Calculate summary map of factors weights
         # Confidence:
@@ -142,29 +203,18 @@ class MCE(object):
         # Prediction:
         #   predicted value is a constant = self.finalStateNum, if current state = self.initState
         #   predicted value is current state, if current state != self.initState
-        confidence = np.zeros((rows,cols))
+        confidence = np.zeros(band.shape, dtype=CONFIDENCE_DTYPE)
         weights = self.getWeights()
-        weightNum = 0               # Number of processed weights
-        for f in self.factors:
-            if not f.geoDataMatch(state):
-                raise MCEError('Geometries of the state and factor rasters are different!')
-            f.normalize(mode = 'maxmin')
-            for i in xrange(f.getBandsCount()):
-                band = f.getBand(i+1)
-                confidence = confidence + band*weights[weightNum]
-                mask = np.ma.mask_or(mask, band.mask)
-                weightNum = weightNum + 1
+        for factor, weight in zip(factors, weights):
+            confidence += ma.getdata(factor)*weight
+            mask = mask | ma.getmaskarray(factor)
         confidence = confidence*initStateMask
-        prediction = np.copy(state.getBand(1))
+        prediction = np.copy(band)
         prediction = np.logical_not(initStateMask) * prediction
         prediction = prediction + initStateMask*self.finalStateNum
+        prediction = prediction.astype(dtype)
 
-        predicted_band = np.ma.array(data=prediction, mask=mask)
-        self.prediction = Raster()
-        self.prediction.create([predicted_band], geodata)
-        confidence_band = np.ma.array(data=confidence, mask=mask)
-        self.confidence = Raster()
-        self.confidence.create([confidence_band], geodata)
+        return [ma.getdata(prediction), ma.getdata(confidence)], mask
 
     def setWeights(self):
         '''
@@ -7,11 +7,14 @@
 from PyQt4.QtCore import *
 
 import copy
+from functools import partial
 
 import numpy as np
 from numpy import ma as ma
 
-from molusce.algorithms.dataprovider import Raster, ProviderError
+from molusce.algorithms.dataprovider import Raster, RastersWriter, ProviderError
+from molusce.algorithms.utils import class_dtype, CHUNK_SIZE, CONFIDENCE_DTYPE
+from molusce.algorithms.parallel import predict_blocks
 from molusce.algorithms.models.mlp.model import MLP, sigmoid
 from molusce.algorithms.models.sampler.sampler import Sampler
 
@@ -48,6 +51,9 @@ class MlpManager(QObject):
         self.train_error = None # Error on training set
         self.val_error   = None # Error on validation set
         self.minValError = None # The minimum error that is achieved on the validation set
+        self.batchSize   = 1    # Count of samples in a training batch (1 = online training)
+        self.trainErrorSamples = None   # Count of samples used for the training error evaluation (None = all training samples)
+        self.processes   = 1    # Count of processes used for prediction (see parallel.imap)
 
         # Results of the MLP prediction
         self.prediction = None  # Raster of the MLP prediction results
@@ -64,23 +70,41 @@ class MlpManager(QObject):
         err = ((sample['output'] - out)**2).sum()/len(out)
         return err
 
+    def computeMlpErrorBlock(self, samples):
+        '''Get summary MLP error on the matrix of samples (one sample per row, see getDataMatrix)'''
+        inputLen = self.getInputVectLen()
+        out = self.getOutputBlock(samples[:, :inputLen])
+        err = ((samples[:, inputLen:] - out)**2).sum(axis=1)/out.shape[1]
+        return err.sum()
+
+    def computeSetError(self, indexes):
+        '''Get mean MLP error on the set of samples. The error is computed by chunks of the samples.
+        @param indexes      Tuple that contains indexes of the first and last elements of the set or array of indexes of the samples.
+        '''
+        data = self.getDataMatrix()
+        chunk = max(1, CHUNK_SIZE/data.shape[1])   # Count of samples in a chunk
+        if isinstance(indexes, tuple):
+            first, last = indexes
+            count = last - first
+            chunks = (data[i:min(i+chunk, last)] for i in xrange(first, last, chunk))
+        else:
+            count = len(indexes)
+            chunks = (data[indexes[i:i+chunk]] for i in xrange(0, count, chunk))
+        error = 0
+        for samples in chunks:
+            error = error + self.computeMlpErrorBlock(samples)
+        return error/count
+
     def computePerformance(self, train_indexes, val_ind):
         '''Check errors of training and validation sets
-        @param train_indexes     Tuple that contains indexes of the first and last elements of the training set.
+        @param train_indexes     Tuple that contains indexes of the first and last elements of the training set
+                                 or array of indexes of the training samples used for error evaluation.
         @param val_ind           Tuple that contains indexes of the first and last elements of the validation set.
         '''
-        train_error = 0
-        train_sampl = train_indexes[1] - train_indexes[0]       # Count of training samples
-        for i in range(train_indexes[0], train_indexes[1]):
-            train_error = train_error + self.computeMlpError(sample = self.data[i])
-        self.setTrainError(train_error/train_sampl)
+        self.setTrainError(self.computeSetError(train_indexes))
 
         if val_ind:
-            val_error = 0
-            val_sampl = val_ind[1] - val_ind[0]
-            for i in xrange(val_ind[0], val_ind[1]):
-                val_error = val_error + self.computeMlpError(sample = self.data[i])
-            self.setValError(val_error/val_sampl)
+            self.setValError(self.computeSetError(val_ind))
 
     def copyWeights(self):
         '''Deep copy of the MLP weights'''
@@ -117,6 +141,12 @@ class MlpManager(QObject):
     def getConfidence(self):
         return self.confidence
 
+    def getDataMatrix(self):
+        '''Return 2-D view of the training data: one sample per row,
+        the inputs (state and factors) are followed by the output vector.
+        '''
+        return self.data.view(np.float).reshape(len(self.data), -1)
+
     def getInputVectLen(self):
         '''Length of input data vector of the MLP'''
         shape = self.getMlpTopology()
@@ -126,6 +156,10 @@ class MlpManager(QObject):
         out = self.MLP.propagate_forward( input_vector )
         return out
 
+    def getOutputBlock(self, inputs):
+        '''Get MLP outputs for the matrix of inputs (one input vector per row)'''
+        return self.MLP.propagate_forward_batch(inputs)
+
     def getOutputVectLen(self):
         '''Length of input data vector of the MLP'''
         shape = self.getMlpTopology()
@@ -164,13 +198,14 @@ class MlpManager(QObject):
     def outputConfidence(self, output):
         '''
         Return confidence (difference between 2 biggest values) of the MLP output.
+        If output is a matrix (one output vector per row), return the vector of confidences.
         '''
         # Scale the output to range [0,1]
         out_scl = 1.0 * (output - self.sigmin) / self.sigrange
 
         # Calculate the confidence:
-        out_scl.sort()
-        return out_scl[-1] - out_scl[-2]
+        out_scl.sort(axis=-1)
+        return out_scl[...,-1] - out_scl[...,-2]
 
 
     def _predict(self, state, factors):
@@ -189,35 +224,77 @@ class MlpManager(QObject):
         for f in factors:
             f.normalize(mode = 'mean')
 
-        predicted_band  = np.zeros([rows, cols])
-        confidence_band = np.zeros([rows, cols])
-
+        # Predict by blocks of rows, every block contains about CHUNK_SIZE input values
         sampler = Sampler(state, factors, ns=self.ns)
-        mask = state.getBand(1).mask.copy()
-        for i in xrange(rows):
-            for j in xrange(cols):
-                if not mask[i,j]:
-                    input = sampler.get_inputs(state, factors, i,j)
-                    if input != None:
-                        out = self.getOutput(input)
-                        # Get index of the biggest output value as the result
-                        biggest = max(out)
-                        res = list(out).index(biggest)
-                        predicted_band[i, j] = self.classlist[res]
-
-                        confidence = self.outputConfidence(out)
-                        confidence_band[i, j] = confidence
-                    else: # Input sample is incomplete => mask this pixel
-                        mask[i, j] = True
-        predicted_bands  = [np.ma.array(data = predicted_band, mask = mask)]
-        confidence_bands = [np.ma.array(data = confidence_band, mask = mask)]
-
-        self.prediction = Raster()
-        self.prediction.create(predicted_bands, geodata)
-        self.confidence = Raster()
-        self.confidence.create(confidence_bands, geodata)
+        blockRows = max(1, CHUNK_SIZE/(cols*self.getInputVectLen()))
+        writer = RastersWriter(geodata, [class_dtype(self.classlist), CONFIDENCE_DTYPE])
+        predict_blocks(
+            partial(self._readBlock, sampler, state, factors), self._predictBlock,
+            writer, rows, blockRows, self.processes
+        )
+        self.prediction, self.confidence = writer.rasters
 
 
+    def _readBlock(self, sampler, state, factors, first, last):
+        '''
+        Read the input samples of rows first, ..., last-1 (see parallel.predict_blocks).
+        @return (samples, valid)    Matrix of the complete samples and the mask of the pixels that have the complete samples.
+        '''
+        inputs, valid = sampler.get_inputs_block(state, factors, first, last)
+        valid = valid & ~ma.getmaskarray(state.getBlock(1, first, 0, last - first, state.getXSize()))
+        return inputs[valid.flatten()], valid
+
+    def _predictBlock(self, inputs):
+        '''
+        Predict the pixels of a block from its input samples (see _readBlock and parallel.predict_blocks).
+        '''
+        samples, valid = inputs
+        predicted  = np.zeros(valid.shape, dtype=class_dtype(self.classlist))
+        confidence = np.zeros(valid.shape, dtype=CONFIDENCE_DTYPE)
+        if valid.any():
+            out = self.getOutputBlock(samples)
+            # Get index of the biggest output value as the result
+            predicted[valid]  = self.classlist[np.argmax(out, axis=1)]
+            confidence[valid] = self.outputConfidence(out)
+        return [predicted, confidence], ~valid   # Input sample is incomplete => mask this pixel
+
+    def updatePrediction(self, state, factors, dirty):
+        '''
+        Recalculate the prediction and the confidence of the dirty pixels only, the other pixels are kept.
+        The state must differ from the state of the last prediction only in the dirty pixels
+        and must have the same mask, the factors must be the same.
+        @param state            Raster of the current state (classes) values.
+        @param factors          List of the factor rasters (predicting variables).
+        @param dirty            Boolean array of the raster shape, it is True where the prediction has to be recalculated.
+        @return                 Raster of the prediction.
+        '''
+        if self.prediction is None:
+            return self.getPrediction(state, factors)
+        for f in factors:
+            f.normalize(mode = 'mean')
+
+        # The blocks of rows that contain dirty pixels are recalculated and written back
+        rows, cols = state.getYSize(), state.getXSize()
+        sampler = Sampler(state, factors, ns=self.ns)
+        blockRows = max(1, CHUNK_SIZE/(cols*self.getInputVectLen()))
+        for first in xrange(0, rows, blockRows):
+            last = min(first + blockRows, rows)
+            if not dirty[first:last].any():
+                continue
+            predicted  = self.prediction.getBlock(1, first, 0, last - first, cols).copy()
+            confidence = self.confidence.getBlock(1, first, 0, last - first, cols).copy()
+            # The masks don't depend on the state values, so masked pixels stay masked
+            r, c = np.nonzero(dirty[first:last] & ~ma.getmaskarray(predicted))
+            if len(r) == 0:
+                continue
+            inputs = sampler.get_inputs_at(state, factors, r + first, c)
+            out = self.getOutputBlock(inputs)
+            ma.getdata(predicted)[r, c]  = self.classlist[np.argmax(out, axis=1)]
+            ma.getdata(confidence)[r, c] = self.outputConfidence(out)
+            self.prediction.setBlock(1, first, 0, predicted)
+            self.confidence.setBlock(1, first, 0, confidence)
+        return self.prediction
+
     def readMlp(self):
         pass
 
@@ -236,7 +313,7 @@ class MlpManager(QObject):
         '''Set weights of the MLP'''
         self.MLP.weights = w
 
-    def setTrainingData(self, state, factors, output, shuffle=True, mode='All', samples=None):
+    def setTrainingData(self, state, factors, output, shuffle=True, mode='All', samples=None, seed=None):
         '''
         @param state            Raster of the current state (classes) values.
         @param factors          List of the factor rasters (predicting variables).
@@ -247,6 +324,7 @@ class MlpManager(QObject):
                                     Normal          Get samples. Count of samples in the data=samples.
                                     Balanced        Undersampling of major classes and/or oversampling of minor classes.
         @samples                Sample count of the training data (doesn't used in 'All' mode).
+        @param seed             Seed of the random generator used by the sampler.
         '''
         if not self.MLP:
             raise MlpManagerError('You must create a MLP before!')
@@ -256,7 +334,7 @@ class MlpManager(QObject):
             f.normalize(mode = 'mean')
 
         sampler = Sampler(state, factors, output, self.ns)
-        sampler.setTrainingData(state, factors, output, shuffle, mode, samples)
+        sampler.setTrainingData(state, factors, output, shuffle, mode, samples, seed=seed)
 
         outputVecLen  = self.getOutputVectLen()
         stateVecLen   = sampler.stateVecLen
@@ -290,16 +368,28 @@ class MlpManager(QObject):
     def setContinueTrain(self, value=False):
         self.continueTrain = value
 
+    def setBatchSize(self, value=1):
+        self.batchSize = value
+
+    def setProcesses(self, value=1):
+        self.processes = value
+
+    def setTrainErrorSamples(self, value=None):
+        self.trainErrorSamples = value
+
     def startTrain(self):
-        self.train(self.epochs, self.valPercent, self.lrate, self.momentum, self.continueTrain)
+        self.train(self.epochs, self.valPercent, self.lrate, self.momentum, self.continueTrain, self.batchSize, self.trainErrorSamples)
 
-    def train(self, epochs, valPercent=20, lrate=0.1, momentum=0.01, continue_train=False):
+    def train(self, epochs, valPercent=20, lrate=0.1, momentum=0.01, continue_train=False, batch_size=1, train_error_samples=None):
         '''Perform the training procedure on the MLP and save the best neural net
         @param epoch            Max iteration count.
         @param valPercent       Percent of the validation set.
         @param lrate            Learning rate.
         @param momentum         Learning momentum.
         @param continue_train   If False then it is new training cycle, reset weights training and validation error. If True, then continue training.
+        @param batch_size       Count of samples in a training batch. If batch_size = 1, then online training is performed.
+        @param train_error_samples  Count of training samples used for evaluation of the training error.
+                                The samples are selected randomly once per training cycle. If None, then all training samples are used.
         '''
 
         samples_count = len(self.data)
@@ -311,14 +401,19 @@ class MlpManager(QObject):
         train_indexes = (0, train_sampl_count)
         val_indexes = (train_sampl_count, samples_count) if apply_validation else None
 
+        # Training samples used for evaluation of the training error
+        train_error_indexes = train_indexes
+        if train_error_samples and train_error_samples < train_sampl_count:
+            train_error_indexes = np.sort(np.random.permutation(train_sampl_count)[:train_error_samples])
+
         if not continue_train: self.resetMlp()
         self.minValError = self.getValError()  # The minimum error that is achieved on the validation set
         last_train_err = self.getTrainError()
         best_weights = self.copyWeights()   # The MLP weights when minimum error that is achieved on the validation set
 
         for epoch in range(epochs):
-            self.trainEpoch(train_indexes, lrate, momentum)
-            self.computePerformance(train_indexes, val_indexes)
+            self.trainEpoch(train_indexes, lrate, momentum, batch_size)
+            self.computePerformance(train_error_indexes, val_indexes)
             self.updateGraph.emit(self.getTrainError(), self.getValError())
             self.updateDeltaRMS.emit(self.getMinValError() - self.getValError())
 
@@ -332,19 +427,30 @@ class MlpManager(QObject):
         self.setMlpWeights(best_weights)
         self.processFinished.emit()
 
-    def trainEpoch(self, train_indexes, lrate=0.1, momentum=0.01):
+    def trainEpoch(self, train_indexes, lrate=0.1, momentum=0.01, batch_size=1):
         '''Perform a training epoch on the MLP
         @param train_ind        Tuple of the min&max indexes of training samples in the samples data.
         @param val_ind          Tuple of the min&max indexes of validation samples in the samples data.
         @param lrate            Learning rate.
         @param momentum         Learning momentum.
+        @param batch_size       Count of samples in a training batch (1 = online training).
         '''
         train_sampl = train_indexes[1] - train_indexes[0]
-
-        for i in range(train_sampl):
-            n = np.random.randint( *train_indexes )
-            sample = self.data[n]
-            input = np.hstack( (sample['state'],sample['factors']) )
-            self.getOutput( input )
-            self.MLP.propagate_backward( sample['output'], lrate, momentum )
+        data = self.getDataMatrix()
+        inputLen = self.getInputVectLen()
+
+        if batch_size <= 1:
+            for i in range(train_sampl):
+                n = np.random.randint( *train_indexes )
+                self.getOutput( data[n, :inputLen] )
+                self.MLP.propagate_backward( data[n, inputLen:], lrate, momentum )
+        else:
+            # Every sample of the training set is used once per epoch
+            order = np.random.permutation(train_sampl) + train_indexes[0]
+            batch = np.empty((min(batch_size, train_sampl), data.shape[1]))
+            for i in xrange(0, train_sampl, batch_size):
+                indexes = order[i:i+batch_size]
+                samples = batch[:len(indexes)]
+                np.take(data, indexes, axis=0, out=samples)
+                self.MLP.train_batch(samples[:, :inputLen], samples[:, inputLen:], lrate, momentum)
 
@@ -10,9 +10,9 @@
 # -----------------------------------------------------------------------------
 import numpy as np
 
-def sigmoid(x):
-    ''' Sigmoid like function using tanh '''
-    return np.tanh(x)
+def sigmoid(x, out=None):
+    ''' Sigmoid like function using tanh, the result is stored in out if it is given '''
+    return np.tanh(x, out=out)
 
 def dsigmoid(x):
     ''' Derivative of sigmoid above '''
@@ -44,6 +44,10 @@ class MLP:
         # dw will hold last change in weights (for momentum)
         self.dw = [0,]*len(self.weights)
 
+        # Buffers of the layers and deltas for batch training (allocated on demand)
+        self.batch_layers = None
+        self.batch_deltas = None
+
         # Reset weights
         self.reset()
 
@@ -69,6 +73,66 @@ class MLP:
         return self.layers[-1]
 
 
+    def propagate_forward_batch(self, data):
+        ''' Propagate matrix of data (one sample per row) from input layer to output layer. '''
+
+        # Set input layer (+1 unit for bias)
+        layer = np.ones((len(data), self.shape[0]+1))
+        layer[:,0:-1] = data
+
+        # Propagate from layer 0 to layer n-1 using sigmoid as activation function
+        for i in range(1,len(self.shape)):
+            layer = sigmoid(np.dot(layer,self.weights[i-1]))
+
+        # Return output (one row per sample)
+        return layer
+
+    def get_batch_buffers(self, size):
+        ''' Return buffers of layers and deltas for a batch of size samples (one sample per row). '''
+
+        # The buffers are reallocated only if the batch is bigger than the buffers
+        if self.batch_layers is None or len(self.batch_layers[0]) < size:
+            # Input layer (+1 unit for bias)
+            self.batch_layers = [np.ones((size, self.shape[0]+1))]
+            self.batch_deltas = []
+            for i in range(1,len(self.shape)):
+                self.batch_layers.append(np.empty((size, self.shape[i])))
+                self.batch_deltas.append(np.empty((size, self.shape[i])))
+        layers = [layer[:size] for layer in self.batch_layers]
+        deltas = [delta[:size] for delta in self.batch_deltas]
+        return layers, deltas
+
+    def train_batch(self, data, target, lrate=0.1, momentum=0.1):
+        ''' Propagate batch of data (one sample per row) forward, then back propagate
+        error related to target (one sample per row) using lrate. The change of the weights
+        is the mean of the changes computed for the samples of the batch. '''
+
+        layers, deltas = self.get_batch_buffers(len(data))
+
+        # Propagate from layer 0 to layer n-1
+        layers[0][:,0:-1] = data
+        for i in range(1,len(self.shape)):
+            np.dot(layers[i-1], self.weights[i-1], out=layers[i])
+            sigmoid(layers[i], out=layers[i])
+
+        # Compute error on output layer
+        error = target - layers[-1]
+        np.multiply(error, dsigmoid(layers[-1]), out=deltas[-1])
+
+        # Compute error on hidden layers
+        for i in range(len(self.shape)-2,0,-1):
+            np.dot(deltas[i],self.weights[i].T, out=deltas[i-1])
+            deltas[i-1] *= dsigmoid(layers[i])
+
+        # Update weights
+        for i in range(len(self.weights)):
+            dw = np.dot(layers[i].T,deltas[i]) / len(data)
+            self.weights[i] += lrate*dw + momentum*self.dw[i]
+            self.dw[i] = dw
+
+        # Return error
+        return (error**2).sum()
+
     def propagate_backward(self, target, lrate=0.1, momentum=0.1):
         ''' Back propagate error related to target using lrate. '''
 
@@ -6,6 +6,7 @@ from numpy import ma as ma
 from PyQt4.QtCore import *
 
 from molusce.algorithms.dataprovider import Raster, ProviderError
+from molusce.algorithms.utils import box_sum, window_view, CHUNK_SIZE
 
 class SamplerError(Exception):
     '''Base class for exceptions in this module.'''
@@ -69,15 +70,51 @@ class Sampler(QObject):
         '''
         try:
             state_data = self.get_state(state, row,col)
-            if state_data == None: # Eliminate incomplete samples
+            if state_data is None: # Eliminate incomplete samples
                 return None
             factors_data = self.get_factors(factors, row,col)
-            if factors_data == None: # Eliminate incomplete samples
+            if factors_data is None: # Eliminate incomplete samples
                 return None
         except ProviderError:
             return None
         return np.hstack( (state_data, factors_data) )
 
+    def get_inputs_block(self, state, factors, first, last):
+        '''
+        Get input samples of the pixels of rows first, first+1, ..., last-1.
+        @param state            Raster of the current state (classes) values.
+        @param factors          List of the factor rasters (predicting variables).
+        @return (inputs, valid) inputs is matrix of the samples (one row per pixel, the pixels are ordered row by row),
+                                valid is boolean array of the block shape, it is False where the sample is incomplete.
+        '''
+        rows, cols = state.getYSize(), state.getXSize()
+        ns = self.ns
+        inputs = np.zeros((last - first, cols, self.stateVecLen + self.factorVectLen))
+        valid  = np.zeros((last - first, cols), dtype=np.bool)
+
+        # Rows and columns of the pixels whose neighbourhoods lie inside the raster
+        r0, r1 = max(first, ns), min(last, rows - ns)
+        c0, c1 = ns, cols - ns
+        if r0 >= r1 or c0 >= c1:
+            return inputs.reshape(-1, inputs.shape[2]), valid
+        block, blockValid = inputs[r0-first:r1-first, c0:c1], valid[r0-first:r1-first, c0:c1]
+        blockValid[...] = True
+
+        size = 2*ns + 1     # Side of the neighbourhood square
+        k = 0 # The number of the processed sample item
+        for raster in [state] + factors:
+            for i in xrange(1, raster.getBandsCount()+1):
+                band = raster.getBlock(i, r0-ns, 0, r1-r0+2*ns, cols)     # Rows of the block and the halo
+                data, mask = ma.getdata(band), ma.getmaskarray(band)
+                # Neighbours are ordered as flatten neighbourhood (see Raster.getNeighbours)
+                neighbours = block[:, :, k:k+size**2]
+                neighbours.shape = (r1 - r0, c1 - c0, size, size)
+                neighbours[...] = window_view(data, ns)
+                if mask.any():
+                    blockValid &= (box_sum(mask, ns) == 0)
+                k = k + size**2
+        return inputs.reshape(-1, inputs.shape[2]), valid
+
     def get_factors(self, factors, row, col):
         '''
         Get input sample at (row, col) pixel and return it as array. Return None if the sample is incomplete.
@@ -112,32 +149,81 @@ class Sampler(QObject):
             return None
         return neighbours
 
-    def _getSample(self, state, factors, output, row, col):
+    def get_inputs_at(self, state, factors, rows, cols):
         '''
-        Get one sample from (row,col) pixel. See params in setTrainingData.
+        Get input samples of the pixels (rows[0], cols[0]), (rows[1], cols[1]), ...
+        The neighbourhoods of the pixels must lie inside the raster.
+        The rasters are read by blocks of rows (with ns-rows halo), only the blocks that contain the pixels are read.
+        @return matrix of the samples (one row per pixel).
         '''
-        data = np.zeros(1, dtype=[('state', float, self.stateVecLen),('factors',  float, self.factorVectLen), ('output', float, self.outputVecLen)])
-        try:
-            out_data = output.getNeighbours(row,col,0).flatten() # Get the pixel
-            if out_data == None:                            # Eliminate masked samples
-                return None
-            else: data['output'] = out_data
-
-            state_data = self.get_state(state, row,col)
-            if state_data == None: # Eliminate incomplete samples
-                return None
-            else: data['state'] = state_data
-
-            factors_data = self.get_factors(factors, row,col)
-            if factors_data == None: # Eliminate incomplete samples
-                return None
-            else: data['factors'] = factors_data
-
-        except ProviderError:
-            return None
-        return data # (state_data, factors_data, out_data)
-
-    def setTrainingData(self, state, factors, output, shuffle=True, mode='All', samples=None):
+        ns = self.ns
+        inputs = np.zeros((len(rows), self.stateVecLen + self.factorVectLen))
+        if len(rows) == 0:
+            return inputs
+        order = np.argsort(rows, kind='mergesort')
+        sortedRows = rows[order]
+        blockRows = max(1, CHUNK_SIZE/state.getXSize())
+        for first in xrange(sortedRows[0], sortedRows[-1] + 1, blockRows):
+            start, stop = np.searchsorted(sortedRows, [first, first + blockRows])
+            if start == stop:
+                continue
+            last = sortedRows[stop - 1] + 1
+            pixels = order[start:stop]
+            k = 0 # The number of the processed sample item
+            for raster in [state] + factors:
+                for i in xrange(1, raster.getBandsCount()+1):
+                    band = raster.getBlock(i, first - ns, 0, last - first + 2*ns, raster.getXSize())
+                    neighbours = window_view(ma.getdata(band), ns)
+                    pixel_count = neighbours.shape[2]*neighbours.shape[3]
+                    inputs[pixels, k:k+pixel_count] = neighbours[rows[pixels] - first, cols[pixels] - ns].reshape(len(pixels), -1)
+                    k = k + pixel_count
+        return inputs
+
+    def get_output_at(self, output, rows, cols):
+        '''
+        Get output values of the pixels (rows[0], cols[0]), (rows[1], cols[1]), ...
+        The output raster is read by blocks of rows, only the blocks that contain the pixels are read.
+        '''
+        values = np.zeros(len(rows))
+        if len(rows) == 0:
+            return values
+        order = np.argsort(rows, kind='mergesort')
+        sortedRows = rows[order]
+        blockRows = max(1, CHUNK_SIZE/output.getXSize())
+        for first in xrange(sortedRows[0], sortedRows[-1] + 1, blockRows):
+            start, stop = np.searchsorted(sortedRows, [first, first + blockRows])
+            if start == stop:
+                continue
+            last = sortedRows[stop - 1] + 1
+            block = ma.getdata(output.getBlock(1, first, 0, last - first, output.getXSize()))
+            pixels = order[start:stop]
+            values[pixels] = block[rows[pixels] - first, cols[pixels]]
+        return values
+
+    def get_valid_mask(self, state, factors, output):
+        '''
+        Return boolean array of the raster shape, it is True where the sample is complete and the output is not masked.
+        '''
+        rows, cols = state.getYSize(), state.getXSize()
+        ns = self.ns
+        valid = np.zeros((rows, cols), dtype=np.bool)
+        if rows <= 2*ns or cols <= 2*ns:
+            return valid
+        interior = valid[ns:rows-ns, ns:cols-ns]
+        interior[...] = True
+        # The masks are read by blocks of rows (with ns-rows halo)
+        blockRows = max(1, CHUNK_SIZE/cols)
+        for first in xrange(ns, rows-ns, blockRows):
+            last = min(first + blockRows, rows - ns)
+            for raster in [state] + factors:
+                for i in xrange(1, raster.getBandsCount()+1):
+                    mask = ma.getmaskarray(raster.getBlock(i, first-ns, 0, last-first+2*ns, cols))
+                    if mask.any():
+                        interior[first-ns:last-ns] &= (box_sum(mask, ns) == 0)
+            valid[first:last] &= ~ma.getmaskarray(output.getBlock(1, first, 0, last-first, cols))
+        return valid
+
+    def setTrainingData(self, state, factors, output, shuffle=True, mode='All', samples=None, replace=True, seed=None):
         '''
         @param state            Raster of the current state (classes) values.
         @param factors          List of the factor rasters (predicting variables).
@@ -148,80 +234,80 @@ class Sampler(QObject):
                                     Normal          Get samples. Count of samples in the data=samples.
                                     Balanced        Undersampling of major classes and/or oversampling of minor classes.
         @samples                Sample count of the training data (doesn't used in 'All' mode).
+        @param replace          Draw the samples with replacement (doesn't used in 'All' mode).
+        @param seed             Seed of the random generator, the same seed gives the same training data.
         '''
 
         for r in factors+[state]:
             if not output.geoDataMatch(r):
                 raise SamplerError('Geometries of the inputs and output rasters are different!')
 
-        # Real count of the samples
-        # (if self.ns>0 some samples may be incomplete because a neighbour has NoData value)
-        samples_count = 0
-
-        rows, cols = state.getXSize(), state.getYSize()
-
-        if mode == 'All':
-            # Approximate sample count:
-            band = state.getBand(1)
-            nulls  =  band.mask.sum() # Count of NA
-            samples = rows * cols - nulls
-
-        # Array for samples
-        self.data = np.zeros(samples, dtype=[('state', float, self.stateVecLen),('factors',  float, self.factorVectLen), ('output', float, self.outputVecLen)])
+        rs = np.random.RandomState(seed)
+        rows, cols = state.getYSize(), state.getXSize()
+        dtype = [('state', float, self.stateVecLen),('factors',  float, self.factorVectLen), ('output', float, self.outputVecLen)]
 
         if mode == 'All':
-            self.rangeChanged.emit(self.tr("Sampling..."), rows - 2*self.ns)
-            # i,j  are pixel indexes
-            for i in xrange(self.ns, rows - self.ns):         # Eliminate the raster boundary (of (ns)-size width) because
-                for j in xrange(self.ns, cols - self.ns):     # the samples are incomplete in that region
-                    sample = self._getSample(state, factors, output, i,j)
-                    if sample != None:
-                        self.data[samples_count] = sample
-                        samples_count = samples_count + 1
+            # The samples are collected by blocks of rows, every block contains about CHUNK_SIZE input values
+            inputVecLen = self.stateVecLen + self.factorVectLen
+            blockRows = max(1, CHUNK_SIZE/(cols*inputVecLen))
+            self.rangeChanged.emit(self.tr("Sampling..."), (rows + blockRows - 1)/blockRows)
+            blocks = []
+            for first in xrange(0, rows, blockRows):
+                last = min(first + blockRows, rows)
+                inputs, valid = self.get_inputs_block(state, factors, first, last)
+                outBlock = output.getBlock(1, first, 0, last - first, cols)
+                valid &= ~ma.getmaskarray(outBlock)     # Eliminate masked samples
+                valid = valid.flatten()
+                block = np.empty((valid.sum(), inputVecLen + self.outputVecLen))
+                block[:, :inputVecLen] = inputs[valid]
+                block[:, inputVecLen:] = ma.getdata(outBlock).reshape(-1, 1)[valid]
+                blocks.append(block)
+                self.updateProgress.emit()
+            # The rows of the matrix are the samples
+            self.data = np.concatenate(blocks).view(dtype).reshape(-1)
+
+        elif mode in ['Normal', 'Balanced']:
+            valid = self.get_valid_mask(state, factors, output)
+            if mode == 'Normal':
+                groups = [np.flatnonzero(valid)]
+            else:
+                # Analyze output classes, the classes without complete samples are skipped.
+                # The pixels of the classes are found by blocks of rows
+                classes = output.getBandStat(1)['gradation']
+                groups = [[] for cl in classes]
+                blockRows = max(1, CHUNK_SIZE/cols)
+                for first in xrange(0, rows, blockRows):
+                    last = min(first + blockRows, rows)
+                    outBlock = ma.getdata(output.getBlock(1, first, 0, last - first, cols))
+                    for group, cl in zip(groups, classes):
+                        group.append(np.flatnonzero(valid[first:last] & (outBlock == cl)) + first*cols)
+                groups = [np.concatenate(g) for g in groups]
+            groups = [g for g in groups if len(g) > 0]
+            if len(groups) == 0:
+                raise SamplerError('The rasters have no complete samples!')
+
+            # Sample counts of the groups: the samples are distributed uniformly among the groups
+            counts = np.zeros(len(groups), dtype=np.int) + samples/len(groups)
+            counts[:samples % len(groups)] += 1
+
+            self.rangeChanged.emit(self.tr("Sampling..."), len(groups))
+            indexes = []
+            for group, count in zip(groups, counts):
+                if not replace and count > len(group):
+                    raise SamplerError('The rasters have not enough samples to select them without replacement!')
+                indexes.append(rs.choice(group, count, replace=replace))
                 self.updateProgress.emit()
-            self.data = self.data[:samples_count]   # Crop unused part of the array
-
-        elif mode == 'Normal':
-            self.rangeChanged.emit(self.tr("Sampling..."), samples)
-            while samples_count< samples:
-                row = np.random.randint(rows)
-                col = np.random.randint(cols)
-                sample = self._getSample(state, factors, output, row,col)
-                if sample != None:
-                    self.data[samples_count] = sample
-                    samples_count = samples_count + 1
-                    self.updateProgress.emit()
-        elif mode == 'Balanced':
-            # Analyze output classes:
-            stat = output.getBandStat(1)
-            classes = stat['gradation']
-            band = output.getBand(1)
-
-            # Select pixels
-            average = 1.0*samples / len(classes)
-
-            samples_count = 0
-            self.rangeChanged.emit(self.tr("Sampling..."), samples)
-            # Get counts[i] samples of "cl" class
-            for i,cl in enumerate(classes):
-                # Find indices of "cl"-class pixels
-                rows, cols = np.where(band == cl)
-                indices = [ (rows[i], cols[i]) for i in xrange(len(cols))]
-
-                # Get samples
-                count = 0
-                while count< average:
-                    index = np.random.randint(len(indices))
-                    row, col = indices[index]
-                    sample = self._getSample(state, factors, output, row,col)
-                    if sample != None:
-                        self.data[samples_count] = sample
-                        samples_count = samples_count + 1
-                        count = count + 1
-                        self.updateProgress.emit()
+            indexes = np.concatenate(indexes)
+
+            rowIndexes, colIndexes = np.unravel_index(indexes, (rows, cols))
+            inputVecLen = self.stateVecLen + self.factorVectLen
+            data = np.empty((len(indexes), inputVecLen + self.outputVecLen))
+            data[:, :inputVecLen] = self.get_inputs_at(state, factors, rowIndexes, colIndexes)
+            data[:, inputVecLen:] = self.get_output_at(output, rowIndexes, colIndexes).reshape(-1, 1)
+            self.data = data.view(dtype).reshape(-1)
         else:
             raise SamplerError('The mode of sampling is unknown!')
 
         if shuffle:
-            np.random.shuffle(self.data)
+            rs.shuffle(self.data)
         self.processFinished.emit()
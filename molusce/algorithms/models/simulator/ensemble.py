@@ -0,0 +1,169 @@
+# encoding: utf-8
+
+import os
+from functools import partial
+
+import numpy as np
+from numpy import ma as ma
+
+from PyQt4.QtCore import *
+
+from osgeo import gdal
+
+from molusce.algorithms.dataprovider import Raster, RasterWriter
+from molusce.algorithms.utils import class_dtype, CHUNK_SIZE, CONFIDENCE_DTYPE
+from molusce.algorithms.parallel import imap, cpu_count, ThreadedWriter
+from molusce.algorithms.models.simulator.sim import Simulator
+
+
+class EnsembleError(Exception):
+    '''Base class for exceptions in this module.'''
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def _realisation(state, factors, model, crosstable, iterations, seed):
+    '''
+    Run one stochastic simulation and return the simulated state (data of the band).
+    '''
+    simulator = Simulator(state, factors, model, crosstable, stochastic=True, seed=seed)
+    simulator.simN(iterations)
+    return ma.getdata(simulator.getState().getBand(1))
+
+
+class Ensemble(QObject):
+    '''
+    Runs a number of stochastic simulations (Monte Carlo realisations) and aggregates their results:
+        transition frequency    part of the realisations where the pixel's class is changed;
+        class probability       part of the realisations where the pixel gets the class (one band per class).
+    A realisation is added to the aggregates as soon as it is computed, the realisations aren't stored.
+    '''
+
+    rangeChanged = pyqtSignal(str, int)
+    updateProgress = pyqtSignal()
+    processFinished = pyqtSignal()
+    logMessage = pyqtSignal(str)
+
+    def __init__(self, state, factors, model, crosstable, processes=None):
+        '''
+        @param state            Raster of the current state (classes) values.
+        @param factors          List of the factor rasters (predicting variables).
+        @param model            Model that is used for predict (see Simulator).
+        @param crosstable       Crosstable, contains transition matrix between states (see Simulator).
+        @param processes        Count of the worker processes, None means the count of CPUs.
+                                The realisations are computed in the current process if processes=1
+                                or the platform doesn't support fork.
+        '''
+        QObject.__init__(self)
+
+        self.state = state
+        self.factors = factors
+        self.model  = model
+        self.crosstable = crosstable
+        self.processes = processes
+
+        self.classes = state.getBandStat(1)['gradation']
+        self.count = 0              # Count of the aggregated realisations
+        self.changes = None         # Count of the realisations where the pixel's class is changed
+        self.classCounts = None     # classCounts[k]: count of the realisations where the pixel has class self.classes[k]
+
+    def run(self, count, iterations=1, seed=None):
+        '''
+        Run the realisations and aggregate their results.
+        @param count            Count of the realisations.
+        @param iterations       Count of the simulation iterations in every realisation.
+        @param seed             Seed of the random generator of the realisations' seeds.
+                                The result doesn't depend on the count of the processes.
+        '''
+        if count < 1:
+            raise EnsembleError('Count of the realisations must be positive!')
+        seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, count)
+
+        shape = (self.state.getYSize(), self.state.getXSize())
+        dtype = class_dtype([count])
+        self.count = 0
+        self.changes = np.zeros(shape, dtype=dtype)
+        self.classCounts = np.zeros((len(self.classes), ) + shape, dtype=dtype)
+
+        self.rangeChanged.emit(self.tr("Monte Carlo simulation %p%"), count)
+        for final in self._realisations(seeds, iterations):
+            self._aggregate(final)
+            self.updateProgress.emit()
+        self.processFinished.emit()
+
+    def _realisations(self, seeds, iterations):
+        '''
+        Generate the simulated states of the realisations in arbitrary order (see parallel.imap).
+        '''
+        processes = self.processes
+        if processes is None:
+            processes = cpu_count()
+        if processes > 1 and not hasattr(os, 'fork'):
+            self.logMessage.emit(self.tr("The platform doesn't support fork, the realisations are computed in one process"))
+        realisation = partial(_realisation, self.state, self.factors, self.model, self.crosstable, iterations)
+        return imap(realisation, [(seed, ) for seed in seeds], processes)
+
+    def _aggregate(self, final):
+        '''
+        Add the simulated state to the counts.
+        '''
+        initial = ma.getdata(self.state.getBand(1))
+        self.changes += (final != initial)
+        for k, cl in enumerate(self.classes):
+            self.classCounts[k] += (final == cl)
+        self.count += 1
+
+    def _frequencyBlock(self, first, last):
+        '''
+        Return list of the frequency bands of rows first, ..., last-1: transition frequency and class probabilities.
+        '''
+        if self.count == 0:
+            raise EnsembleError('The realisations are not computed!')
+        mask = ma.getmaskarray(self.state.getBlock(1, first, 0, last - first, self.state.getXSize()))
+        bands = [self.changes[first:last]] + [c[first:last] for c in self.classCounts]
+        return [ma.array(data=b.astype(CONFIDENCE_DTYPE) / self.count, mask=mask) for b in bands]
+
+    def getFrequency(self):
+        '''
+        Return raster of the transition frequency.
+        '''
+        rows = self.state.getYSize()
+        raster = Raster()
+        raster.create(self._frequencyBlock(0, rows)[:1], self.state.getGeodata())
+        return raster
+
+    def getProbability(self):
+        '''
+        Return raster of the class probabilities, band k is the probability of class self.classes[k-1].
+        '''
+        rows = self.state.getYSize()
+        raster = Raster()
+        raster.create(self._frequencyBlock(0, rows)[1:], self.state.getGeodata())
+        return raster
+
+    def save(self, frequencyFilename=None, probabilityFilename=None, format="GTiff", nodata=-1, options=None):
+        '''
+        Save the transition frequency and the class probabilities block by block (see RasterWriter),
+        the blocks are written in background threads while the next blocks are computed.
+        @param frequencyFilename    Name of the transition frequency raster file, None means don't save.
+        @param probabilityFilename  Name of the class probabilities raster file, None means don't save.
+        @param nodata               NoData value of the files.
+        @param options              List of the creation options of the driver (see RasterWriter.gtiffOptions).
+        '''
+        geodata = self.state.getGeodata()
+        writers = []
+        try:
+            if frequencyFilename:
+                writers.append((ThreadedWriter(RasterWriter(frequencyFilename, geodata, 1, gdal.GDT_Float32, format, nodata, options)), slice(0, 1)))
+            if probabilityFilename:
+                writers.append((ThreadedWriter(RasterWriter(probabilityFilename, geodata, len(self.classes), gdal.GDT_Float32, format, nodata, options)), slice(1, None)))
+
+            rows, cols = geodata['ySize'], geodata['xSize']
+            blockRows = max(1, CHUNK_SIZE/(cols*(len(self.classes) + 1)))
+            for i in xrange(0, rows, blockRows):
+                bands = self._frequencyBlock(i, min(i + blockRows, rows))
+                for writer, bandSlice in writers:
+                    writer.writeBlocks([(i, 0, bands[bandSlice])])
+        finally:
+            for writer, bandSlice in writers:
+                writer.close()
@@ -1,12 +1,20 @@
 import unittest
 
 import numpy as np
+from numpy import ma as ma
 
 from PyQt4.QtCore import *
 
 from molusce.algorithms.dataprovider import Raster
+from molusce.algorithms.utils import class_dtype, top_indexes, dilate, CHUNK_SIZE
 from molusce.algorithms.models.mlp.manager import MlpManager
-from molusce.algorithms.models.area_analysis.manager import AreaAnalyst
+
+
+class SimulatorError(Exception):
+    '''Base class for exceptions in this module.'''
+    def __init__(self, msg):
+        self.msg = msg
+
 
 class Simulator(QObject):
     """
@@ -19,15 +27,22 @@ class Simulator(QObject):
     processFinished = pyqtSignal()
     logMessage = pyqtSignal(str)
 
-    def __init__(self, state, factors, model, crosstable):
+    def __init__(self, state, factors, model, crosstable, stochastic=False, seed=None):
         '''
         @param state            Raster of the current state (classes) values.
         @param factors          List of the factor rasters (predicting variables).
         @param model            Model that is used for predict. The model implements metods:
-                                getConfidence(), getPrediction(state, self.factors)
+                                getConfidence(), getPrediction(state, self.factors).
+                                The model can implement updatePrediction(state, self.factors, dirty) method,
+                                it recalculates the prediction of the dirty pixels only and returns the prediction
+                                (see Simulator.updatePrediction). Attribute ns of the model is its neighbourhood size.
         @param crosstable       Crosstable, contains transition matrix between states T(i,j).
                                 The matrix contains number of pixels that are moved
                                 from init class i to final class j.
+        @param stochastic       Use stochastic allocation of the transitions: the places are selected randomly
+                                with probabilities proportional to the confidence (see Simulator.sim).
+                                Deterministic allocation selects the places with the biggest confidence.
+        @param seed             Seed of the random generator of the stochastic allocation.
         '''
         QObject.__init__(self)
 
@@ -38,6 +53,12 @@ class Simulator(QObject):
         self.model  = model
         self.crosstable = crosstable
 
+        self.stochastic = stochastic
+        self.random = np.random.RandomState(seed)
+
+        # Classes are fixed during the simulation, the transitions are encoded via indexes of the classes
+        self.classes = self.state.getBandStat(1)['gradation']
+
         self.updatePrediction(self.state)
 
 
@@ -63,9 +84,17 @@ class Simulator(QObject):
         correct pixel is marked as 0.
         '''
         state = self.getState()
-        b = state.getBand(1)
-        a = answer.getBand(1)
-        diff = (a-b).astype(int)
+        # The difference of the classes is stored as signed integer
+        classes = [0] + answer.getBandStat(1)['gradation'] + state.getBandStat(1)['gradation']
+        dtype = class_dtype([min(classes) - max(classes), max(classes) - min(classes)])
+        rows, cols = state.getYSize(), state.getXSize()
+        diff = ma.zeros((rows, cols), dtype=dtype)
+        blockRows = max(1, CHUNK_SIZE/cols)     # The rasters are compared by blocks of rows
+        for first in xrange(0, rows, blockRows):
+            height = min(blockRows, rows - first)
+            a = answer.getBlock(1, first, 0, height, cols)
+            b = state.getBlock(1, first, 0, height, cols)
+            diff[first:first+height] = a.astype(dtype) - b.astype(dtype)
         result = Raster()
         result.create([diff], state.getGeodata())
         return result
@@ -74,54 +103,106 @@ class Simulator(QObject):
         '''
         Make 1 iteracion of simulation.
         '''
-        #TODO: eleminate AreaAnalyst.getChangeMap() from the process
-
         transition = self.crosstable.getCrosstable()
 
         prediction = self.getPrediction()
         state = self.getState()
-        new_state = state.getBand(1).copy()         # New states (the result of simulation) will be stored there.
-        analyst = AreaAnalyst(state, prediction)
-        classes = analyst.classes
-        changes = analyst.getChangeMap().getBand(1)
+        # New states (the result of simulation) will be stored there, the state is copied by blocks
+        new_state = ma.zeros((state.getYSize(), state.getXSize()), dtype=state.get_dtype())
+        for row, col, [block] in state.iterBlocks(1):
+            new_state[row:row+block.shape[0], col:col+block.shape[1]] = block
+        changed = np.zeros(new_state.shape, dtype=np.bool)     # Pixels that are changed in the iteration
+        classes = self.classes
+        m = len(classes)
+
+        codes, places, confidence = self._transitionPlaces(state, prediction, self.getConfidence())
 
         # Make transition between classes according to
         # number of moved pixel in crosstable
-        self.rangeChanged.emit(self.tr("Simulation process %p%"), len(classes)**2 - len(classes))
-        for initClass in classes:
-            for finalClass in classes:
+        self.rangeChanged.emit(self.tr("Simulation process %p%"), m**2 - m)
+        for initIndex, initClass in enumerate(classes):
+            for finalIndex, finalClass in enumerate(classes):
                 if initClass == finalClass: continue
 
                 # TODO: Calculate number of pixels to be moved via TransitoionMatrix and state raster
                 n = transition.getTransition(initClass, finalClass)   # Number of pixels to be moved (constant count now).
-                # Find n appropriate places for transition initClass -> finalClass
-                class_code = analyst.encode(initClass, finalClass)
-                places = (changes==class_code)      # Array of places where transitions initClass -> finalClass are occured
-                placesCount = np.sum(places)
+                # Places where transitions initClass -> finalClass are occured
+                class_code = initIndex*m + finalIndex
+                first, last = np.searchsorted(codes, [class_code, class_code + 1])
+                placesCount = last - first
                 if placesCount < n:
                     self.logMessage.emit(self.tr("There are more transitions in the transition matrix, then the model have found"))
                     n = placesCount
 
-                confidence = self.getConfidence().getBand(1)
-                confidence = confidence * places # The higher is number in cell, the higer is probability of transition in the cell
-                indices = []
-                for i in range(n):
-                    index = np.unravel_index(confidence.argmax(), confidence.shape)     # Select the cell with biggest probability
-                    indices.append(index)
-                    confidence[index] = -1       # Mark the cell to prevent second selection
-
-                # Now "indices" contains indices of the appropriate places,
-                # make transition initClass -> finalClass
-                for index in indices:
-                    new_state[index] = finalClass
+                # Select n places with the biggest confidence (the higher is number in cell, the higer is probability of transition in the cell),
+                # the place with smaller index is selected if the confidences are equal.
+                # Then make transition initClass -> finalClass
+                indices = places[first:last]
+                weights = confidence[first:last]
+                if self.stochastic:
+                    weights = self._randomKeys(weights)
+                indices = indices[top_indexes(weights, n)]
+                new_state.ravel()[indices] = finalClass
+                changed.ravel()[indices] = True
                 self.updateProgress.emit()
 
         result = Raster()
         result.create([new_state], state.getGeodata())
         self.state = result
-        self.updatePrediction(result)
+        self.updatePrediction(result, changed)
         self.processFinished.emit()
 
+    def _randomKeys(self, weights):
+        '''
+        Return random keys of the weighted sampling without replacement (Efraimidis-Spirakis):
+        n items with the biggest keys key = u**(1/weight), u ~ U(0,1], are weighted random sample of size n.
+        The keys are computed as log(u)/weight, items of zero (or negative) weight get -inf keys.
+        '''
+        u = 1.0 - self.random.random_sample(len(weights))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(u) / np.maximum(weights, 0)
+
+    def _transitionPlaces(self, state, prediction, confidence):
+        '''
+        Find places of the transitions predicted by the model, the rasters are read by blocks of rows.
+        @param state            Raster of the current state.
+        @param prediction       Raster of the predicted state.
+        @param confidence       Raster of the prediction confidence, masked pixels of the confidence aren't places.
+        @return (codes, places, weights) places is array of flat indexes of the pixels where the predicted class differs from the state,
+                                the pixels are grouped by codes of the transitions: codes[k] = initIndex*m + finalIndex is the code of
+                                the places[k] pixel, where initIndex, finalIndex are indexes of the classes in self.classes, m = len(self.classes).
+                                The places of a transition are ordered by the flat index. weights[k] is the confidence of the places[k] pixel.
+        '''
+        classes = np.array(self.classes)
+        m = len(classes)
+        if m == 0:
+            return np.zeros(0, dtype=np.int), np.zeros(0, dtype=np.int), np.zeros(0)
+        rows, cols = state.getYSize(), state.getXSize()
+
+        codes, places, weights = [], [], []
+        blockRows = max(1, CHUNK_SIZE/cols)
+        for first in xrange(0, rows, blockRows):
+            height = min(blockRows, rows - first)
+            bands = [r.getBlock(1, first, 0, height, cols) for r in [state, prediction, confidence]]
+            mask = ma.getmaskarray(bands[0]) | ma.getmaskarray(bands[1]) | ma.getmaskarray(bands[2])
+
+            indexes = []
+            for band in bands[:2]:
+                data = ma.getdata(band)
+                index = np.searchsorted(classes, data)
+                np.clip(index, 0, m-1, index)
+                if (~mask & (classes[index] != data)).any():
+                    raise SimulatorError("List of classes of the initial state doesn't contain a class of the state or the prediction!")
+                indexes.append(index)
+            initIndex, finalIndex = indexes
+
+            blockPlaces = np.flatnonzero(~mask & (initIndex != finalIndex))
+            codes.append(initIndex.ravel()[blockPlaces]*m + finalIndex.ravel()[blockPlaces])
+            weights.append(ma.getdata(bands[2]).ravel()[blockPlaces])
+            places.append(blockPlaces + first*cols)
+        codes, places, weights = np.concatenate(codes), np.concatenate(places), np.concatenate(weights)
+        order = np.argsort(codes, kind='mergesort')     # Stable sort keeps the places of a transition ordered
+        return codes[order], places[order], weights[order]
 
     def simN(self, N):
         '''
@@ -130,9 +211,17 @@ class Simulator(QObject):
         for i in range(N):
             self.sim()
 
-    def updatePrediction(self, state):
+    def updatePrediction(self, state, changed=None):
         '''
         Update prediction using new classes (raster "state")
+        @param changed          Boolean array of the raster shape, it is True where the state is changed
+                                since the last prediction. If the model can update the prediction, only the pixels
+                                whose neighbourhoods contain the changed pixels are recalculated.
+                                None means the full prediction.
         '''
-        self.predicted = self.model.getPrediction(state, self.factors)
+        if changed is None or not hasattr(self.model, 'updatePrediction'):
+            self.predicted = self.model.getPrediction(state, self.factors)
+            return
+        dirty = dilate(changed, getattr(self.model, 'ns', 0))
+        self.predicted = self.model.updatePrediction(state, self.factors, dirty)
 
@@ -1,10 +1,14 @@
 # encoding: utf-8
 
+from functools import partial
+
 import numpy as np
+from numpy import ma as ma
 
-from molusce.algorithms.dataprovider import Raster
-from model import woe
-from molusce.algorithms.utils import binaryzation, masks_identity, reclass
+from molusce.algorithms.dataprovider import Raster, RastersWriter
+from model import woe_codes
+from molusce.algorithms.utils import class_dtype, reclass, CHUNK_SIZE, CONFIDENCE_DTYPE
+from molusce.algorithms.parallel import predict_blocks
 
 
 def sigmoid(x):
@@ -18,8 +22,10 @@ class WoeManagerError(Exception):
 class WoeManager(object):
     '''This class gets the data extracted from the UI and
     pass it to woe function, then gets and stores the result.
+    The weights are computed from the whole bands of the factors (the bands of lazy rasters are read entirely),
+    the prediction is computed by blocks of rows.
     '''
-    def __init__(self, factors, areaAnalyst, unit_cell=1, bins = None):
+    def __init__(self, factors, areaAnalyst, unit_cell=1, bins = None, processes=1):
         '''
         @param factors      List of the pattern rasters used for prediction of point objects (sites).
         @param areaAnalyst  AreaAnalyst that contains map of the changes, encodes and decodes class numbers.
@@ -28,6 +34,7 @@ class WoeManager(object):
                                 For example if factors = [f0, f1], then bins could be (for example) {0:[bins for f0], 1:[bins for f1]} = {0:[[10, 100, 250]],1:[[0.2, 1, 1.5, 4]]}.
                                 List of list used because a factor can be a multiband raster, we need get a list of bins for every band. For example:
                                 factors = [f0, 2-band-factor], bins= {0: [[10, 100, 250]], 1:[[0.2, 1, 1.5, 4], [3, 4, 7]] }
+        @param processes    Count of processes used for prediction (see parallel.imap).
         '''
 
         self.factors = factors
@@ -36,8 +43,9 @@ class WoeManager(object):
 
         self.prediction = None
         self.confidence = None
+        self.processes = processes
 
-        if (bins != None) and (len(factors) != len(bins.keys())):
+        if (bins is not None) and (len(factors) != len(bins.keys())):
             raise WoeManagerError('Lengths of bins and factors are different!')
 
         for r in self.factors:
@@ -53,26 +61,31 @@ class WoeManager(object):
 
         self.codes = [int(c) for c in classes]    # Codes of transitions initState->finalState (see AreaAnalyst.encode)
 
+        # Reclass factors (continuous factor -> ordinal factor)
+        bands = []
+        for k in xrange(len(factors)):
+            fact = factors[k]
+            if bins: # Get bins of the factor
+                bin = bins[k]
+                if (bin != None) and fact.getBandsCount() != len(bin):
+                    raise WoeManagerError("Count of bins list for multiband factor is't equal to band count!")
+            else: bin = None
+            for i in range(1, fact.getBandsCount()+1):
+                band = fact.getBand(i)
+                if bin:
+                    band = reclass(band, bin[i-1])
+                bands.append(band)
+
+        # WoE of all transitions are calculated from the joint histograms of the factor classes and the codes
         self.woe = {}
         for code in self.codes:
-            sites = binaryzation(cMap, [code])
-            # TODO: reclass factors (continuous factor -> ordinal factor)
-            wMap = np.ma.zeros(cMap.shape)
-            for k in xrange(len(factors)):
-                fact = factors[k]
-                if bins: # Get bins of the factor
-                    bin = bins[k]
-                    if (bin != None) and fact.getBandsCount() != len(bin):
-                        raise WoeManagerError("Count of bins list for multiband factor is't equal to band count!")
-                else: bin = None
-                for i in range(1, fact.getBandsCount()+1):
-                    band = fact.getBand(i)
-                    if bin:
-                        band = reclass(band, bin[i-1])
-                    band, sites = masks_identity(band, sites)   # Combine masks of the rasters
-                    weights = woe(band, sites, unit_cell)       # WoE for the 'code' (initState->finalState) transition and current 'factor'.
-                    wMap = wMap + weights
-            self.woe[code]=wMap             # WoE for all factors and the transition.
+            self.woe[code] = np.ma.zeros(cMap.shape)
+        mask = ma.getmaskarray(cMap)
+        for band in bands:
+            mask = mask | ma.getmaskarray(band)     # Combine masks of the rasters
+            weights = woe_codes(ma.array(band, mask=mask), ma.array(cMap, mask=mask), self.codes, unit_cell)
+            for code in self.codes:     # WoE for the 'code' (initState->finalState) transition and current 'factor'.
+                self.woe[code] = self.woe[code] + weights[code]
 
 
     def getConfidence(self):
@@ -85,6 +98,29 @@ class WoeManager(object):
         self._predict(state)
         return self.prediction
 
+    def updatePrediction(self, state, factors, dirty):
+        '''
+        Recalculate the prediction and the confidence of the blocks of rows that contain dirty pixels only,
+        the other blocks are kept. The prediction of a pixel depends on the pixel only (ns=0), so the recalculated
+        blocks are the same as the blocks of the full prediction.
+        @param state            Raster of the current state (classes) values.
+        @param factors          List of the factor rasters (they aren't used, WoE uses the factors of the initialization).
+        @param dirty            Boolean array of the raster shape, it is True where the prediction has to be recalculated.
+        @return                 Raster of the prediction.
+        '''
+        if self.prediction is None:
+            return self.getPrediction(state, factors)
+        rows, cols = state.getYSize(), state.getXSize()
+        blockRows = max(1, CHUNK_SIZE/(cols*max(1, len(self.analyst.classes))))
+        for first in xrange(0, rows, blockRows):
+            last = min(first + blockRows, rows)
+            if not dirty[first:last].any():
+                continue
+            bands, mask = self._predictBlock(self._readBlock(state, first, last))
+            self.prediction.setBlock(1, first, 0, ma.array(data=bands[0], mask=mask))
+            self.confidence.setBlock(1, first, 0, ma.array(data=bands[1], mask=mask))
+        return self.prediction
+
     def getWoe(self):
         return self.woe
 
@@ -97,40 +133,61 @@ class WoeManager(object):
         if not self.changeMap.geoDataMatch(state):
             raise WoeManagerError('Geometries of the state and changeMap rasters are different!')
 
-        prediction = np.zeros((rows,cols))
-        confidence = np.zeros((rows,cols))
-        mask = np.zeros((rows,cols))
-
-        woe = self.getWoe()
-        stateBand = state.getBand(1)
-
-        for r in xrange(rows):
-            for c in xrange(cols):
-                oldMax, currMax = -1000, -1000  # Small numbers
-                indexMax = -1                   # Index of Max weight
-                initClass = stateBand[r,c]      # Init class (state before transition)
-                try:
-                    codes = self.analyst.codes(initClass)   # Possible final states
-                    for code in codes:
-                        try: # If not all possible transitions are presented in the changeMap
-                            map = woe[code]     # Get WoE map of transition 'code'
-                        except KeyError:
-                            continue
-                        w = map[r,c]        # The weight in the (r,c)-pixel
-                        if w > currMax:
-                            indexMax, oldMax, currMax = code, currMax, w
-                    decode = self.analyst.decode(indexMax)    # Get init & final classes (initState, finalState)
-                    prediction[r,c] = decode[1]               # final class
-                    confidence[r,c] = sigmoid(currMax) - sigmoid(oldMax)
-                except ValueError:
-                    mask[r,c] = 1
-
-        predicted_band = np.ma.array(data=prediction, mask=mask)
-        self.prediction = Raster()
-        self.prediction.create([predicted_band], geodata)
-        confidence_band = np.ma.array(data=confidence, mask=mask)
-        self.confidence = Raster()
-        self.confidence.create([confidence_band], geodata)
-
+        # Predict by blocks of rows, every block contains about CHUNK_SIZE weights
+        blockRows = max(1, CHUNK_SIZE/(cols*max(1, len(self.analyst.classes))))
+        writer = RastersWriter(geodata, [class_dtype(self.analyst.classes), CONFIDENCE_DTYPE])
+        predict_blocks(
+            partial(self._readBlock, state), self._predictBlock,
+            writer, rows, blockRows, self.processes
+        )
+        self.prediction, self.confidence = writer.rasters
 
+    def _readBlock(self, state, first, last):
+        '''
+        Read the state band and the WoE maps of rows first, ..., last-1 (see parallel.predict_blocks).
+        '''
+        woe = dict((code, map[first:last]) for code, map in self.getWoe().items())
+        return state.getBlock(1, first, 0, last - first, state.getXSize()), woe
 
+    def _predictBlock(self, inputs):
+        '''
+        Predict the pixels of a block from the blocks of the state and the WoE maps (see _readBlock and parallel.predict_blocks).
+        '''
+        stateBand, woe = inputs
+        stateData, stateMask = ma.getdata(stateBand).ravel(), ma.getmaskarray(stateBand).ravel()
+        classes = self.analyst.classes
+        m = len(classes)
+
+        prediction = np.zeros(stateBand.shape, dtype=class_dtype(classes))
+        confidence = np.zeros(stateBand.shape, dtype=CONFIDENCE_DTYPE)
+        mask = np.ones(stateBand.shape, dtype=np.bool)
+
+        for initClass in classes:
+            # Possible final states (not all possible transitions are presented in the changeMap)
+            codes = [code for code in self.analyst.codes(initClass) if code in woe]
+            pixels = np.flatnonzero((stateData == initClass) & ~stateMask)
+            if len(codes) == 0 or len(pixels) == 0:
+                continue
+
+            # Weights of the transitions (one row per code) in the pixels, masked weights are never chosen
+            weights = np.empty((len(codes), len(pixels)))
+            for k, code in enumerate(codes):
+                map = woe[code]     # WoE map of transition 'code'
+                weights[k] = ma.getdata(map).ravel()[pixels]
+                weights[k][ma.getmaskarray(map).ravel()[pixels]] = -np.inf
+
+            # The biggest and the second biggest weights
+            index = np.arange(len(pixels))
+            indexMax = np.argmax(weights, axis=0)
+            currMax = weights[indexMax, index]
+            weights[indexMax, index] = -np.inf
+            oldMax = weights.max(axis=0)
+
+            found = currMax > -np.inf   # The pixels without any weight stay masked
+            pixels = pixels[found]
+            finalClasses = np.array(classes)[np.array(codes) % m]
+            prediction.flat[pixels] = finalClasses[indexMax[found]]
+            confidence.flat[pixels] = sigmoid(currMax[found]) - sigmoid(oldMax[found])
+            mask.flat[pixels] = False
+
+        return [prediction, confidence], mask
@@ -52,6 +52,19 @@ def _binary_woe(factor, sites, unitcell=1):
     siteAndPatten = fm&sm       # Sites inside area where the factor occurs
     Nb = 1.0 * len(siteAndPatten[siteAndPatten==True]) # Count of sites inside factor area 
 
+    return _weights(A, B, N, Nb)
+
+def _weights(A, B, N, Nb):
+    '''
+    Weights of evidence calculated from the areas (binary form, see _binary_woe).
+    
+    @param A          Total map area in unit cells.
+    @param B          Total factor area in unit cells.
+    @param N          Count of sites.
+    @param Nb         Count of sites inside factor area.
+    
+    @return (W+, W-)  Tuple of the factor's weights (w+, w-).
+    '''
     # Check areas size
     if A == 0:
         raise WoeError('Unmasked area is zero-size!')
@@ -78,6 +91,21 @@ def _binary_woe(factor, sites, unitcell=1):
     wMinus = np.math.log(pSiteNonFactor/pNonSiteNonFactor)
 
     return Weights(wPlus, wMinus)
+
+def _total_weights(weights):
+    '''
+    Total weights of the factor classes.
+    
+    @param weights    List of the weights (w+, w-) of the classes.
+    '''
+    wTotalMin = sum([w[1] for w in weights])
+    wMap = [w[0] + wTotalMin - w[1] for w in weights]
+    
+    # If len(classes) = 2, then [w[0] + wTotalMin - w[1] for w in weights] increases the answer.
+    # In this case:
+    if len(weights) == 2:
+        wMap = [w/2 for w in wMap]
+    return wMap
     
 def woe(factor, sites, unit_cell=1):
     '''Weight of evidence method (multiclass form).
@@ -107,13 +135,7 @@ def woe(factor, sites, unit_cell=1):
     else:
         raise WoeError('Wrong count of classes in the factor raster!') 
     
-    wTotalMin = sum([w[1] for w in weights])
-    wMap = [w[0] + wTotalMin - w[1] for w in weights]
-    
-    # If len(classes) = 2, then [w[0] + wTotalMin - w[1] for w in weights] increases the answer.
-    # In this case:
-    if len(classes) == 2:
-        wMap = [w/2 for w in wMap]
+    wMap = _total_weights(weights)
     
     for i,cl in enumerate(classes):
         result[factor==cl] = wMap[i]
@@ -122,6 +144,55 @@ def woe(factor, sites, unit_cell=1):
     return result
     
     
+def woe_codes(factor, codeMap, codes, unit_cell=1):
+    '''Weight of evidence method (multiclass form) for several site layers at once.
+    The result is the same as woe(factor, binaryzation(codeMap, [code]), unit_cell) for every code,
+    but all weights are calculated from one joint histogram of the factor classes and the codes.
+    
+    @param factor     Multiclass pattern array used for prediction of point objects (sites).
+    @param codeMap    Array of codes, the sites of a code are the pixels that have value of the code.
+    @param codes      List of the codes.
+    @param unit_cell  Method parameter, pixelsize of resampled rasters.
+    
+    @return {code: wMap, ...}   Total weights of the factor for each code.
+    '''
+    if factor.shape != codeMap.shape:
+        raise WoeError('Factor and sites rasters have different shapes!')
+    mask = ma.getmaskarray(factor) | ma.getmaskarray(codeMap)
+    fm = ma.getdata(factor)[~mask]
+    cm = ma.getdata(codeMap)[~mask]
+
+    # Get list of classes from the factor raster
+    classes = np.unique(fm)
+    if len(classes) < 2:
+        raise WoeError('Wrong count of classes in the factor raster!')
+    codes = list(codes)
+    sortedCodes = np.unique(codes)
+
+    # Joint histogram: hist[i,j] is count of the pixels of i-th class and j-th code
+    fIndex = np.searchsorted(classes, fm)
+    cIndex = np.searchsorted(sortedCodes, cm)
+    np.clip(cIndex, 0, len(sortedCodes)-1, cIndex)
+    cIndex[sortedCodes[cIndex] != cm] = len(sortedCodes)    # Pixels of other codes
+    n = len(sortedCodes) + 1
+    hist = np.bincount(fIndex*n + cIndex, minlength=len(classes)*n).reshape(len(classes), n)
+
+    A  = 1.0 * len(fm)/unit_cell                # Total map area in unit cells
+    classArea = hist.sum(axis=1)                # Area of the classes
+    siteCount = hist.sum(axis=0)                # Count of sites of the codes
+
+    result = {}
+    for code in codes:
+        j = np.searchsorted(sortedCodes, code)
+        N = 1.0 * siteCount[j]                  # Count of sites
+        if N == 0 or N == len(fm):
+            raise WoeError('Site raster must be binary!')
+        weights = [_weights(A, 1.0 * classArea[i]/unit_cell, N, 1.0 * hist[i, j]) for i in xrange(len(classes))]
+        wMap = np.zeros(factor.shape)
+        wMap[~mask] = np.array(_total_weights(weights))[fIndex]
+        result[code] = ma.array(data=wMap, mask=mask)
+    return result
+
 def contrast(wPlus, wMinus):
     'Weight contrast'
     return wPlus - wMinus
@@ -0,0 +1,237 @@
+# encoding: utf-8
+
+'''
+Execution of independent tasks (blocks of rasters, realisations of simulation) on a pool of processes
+and threaded I/O pipeline of raster blocks.
+
+The function of the tasks is passed to the initializer of the pool workers. The workers are forked,
+so they share the function (usually a bound method of a model and the rasters) with the parent process
+(copy-on-write): only the task arguments and the results are pickled.
+
+The I/O threads overlap reading and writing of the blocks with computation (GDAL releases GIL during I/O),
+for example predict_blocks reads the next block ahead and writes the predicted blocks in background threads.
+A GDAL dataset must be used by one thread at a time: the raster read by prefetch (or written by ThreadedWriter)
+must not be used by other threads until the iteration is finished (the writer is closed).
+'''
+
+import os
+import multiprocessing
+import threading
+import Queue
+from functools import partial
+
+from numpy import ma as ma
+
+
+_function = None    # Function of the tasks in a worker process
+
+def _init(function):
+    global _function
+    _function = function
+
+def _call(args):
+    return _function(*args)
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def _processes(processes, count):
+    '''
+    Return count of the worker processes for count tasks, 1 means the tasks are run in the current process (see imap).
+    '''
+    if processes is None:
+        processes = cpu_count()
+    processes = min(processes, count)
+    if processes <= 1 or not hasattr(os, 'fork') or multiprocessing.current_process().daemon:
+        return 1
+    return processes
+
+def imap(function, tasks, processes=1, maxtasksperchild=None):
+    '''
+    Generate results of function(*args) for args in tasks.
+    @param function     Function of the tasks, it is not pickled.
+    @param tasks        List of argument tuples of the tasks, the arguments are pickled (use small arguments).
+    @param processes    Count of the worker processes, None means the count of CPUs.
+                        The tasks are run in the current process if processes=1, the platform doesn't support fork
+                        or the current process is a worker (the workers can't have children).
+    @param maxtasksperchild Count of the tasks after which a worker is replaced by a new one, None means
+                        the workers live as long as the pool.
+    @return             Generator of the results, the results are generated in arbitrary order.
+    '''
+    processes = _processes(processes, len(tasks))
+    if processes == 1:
+        for args in tasks:
+            yield function(*args)
+        return
+
+    # The initializer is run by every worker including the workers that replace exited ones
+    pool = multiprocessing.Pool(processes, _init, (function, ), maxtasksperchild)
+    try:
+        for result in pool.imap_unordered(_call, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _predictBlock(read, predict, first, last):
+    bands, mask = predict(read(first, last))
+    return first, bands, mask
+
+def _predictPrefetched(read, predict, tasks):
+    inputs = prefetch((first, read(first, last)) for first, last in tasks)
+    try:
+        for first, blockInputs in inputs:
+            bands, mask = predict(blockInputs)
+            yield first, bands, mask
+    finally:
+        inputs.close()
+
+def predict_blocks(read, predict, writer, rows, blockRows, processes=1):
+    '''
+    Compute bands of a prediction (prediction and confidence for example) by blocks of rows
+    and write the blocks of the bands via the writer.
+    The blocks are written in a background thread (see ThreadedWriter). If the blocks are predicted in the current process,
+    the inputs of the next block are read in a background thread while the current block is predicted (see prefetch).
+    @param read         read(first, last) returns inputs of rows first, ..., last-1: blocks of the rasters
+                        (with ns-pixel halo for the neighbourhoods of the pixels).
+                        The workers read the blocks from the rasters shared with the parent process.
+    @param predict      predict(inputs) returns ([arrays of the bands], mask) of the rows, it doesn't read the rasters.
+    @param writer       Writer of the bands (see dataprovider.RasterWriter and dataprovider.RastersWriter),
+                        the bands are masked where the mask of predict is True. The writer is closed at the end.
+    @param rows         Count of the rows of the bands.
+    @param blockRows    Maximal count of rows in a block, the raster is split into at least processes blocks.
+    @param processes    Count of the worker processes (see imap).
+    '''
+    if processes is None:
+        processes = cpu_count()
+    blockRows = max(1, min(blockRows, -(-rows // max(1, processes))))
+    tasks = [(i, min(i + blockRows, rows)) for i in xrange(0, rows, blockRows)]
+
+    if _processes(processes, len(tasks)) == 1:
+        blocks = _predictPrefetched(read, predict, tasks)
+    else:
+        blocks = imap(partial(_predictBlock, read, predict), tasks, processes)
+    writer = ThreadedWriter(writer)
+    try:
+        for first, bands, mask in blocks:
+            writer.writeBlocks([(first, 0, [ma.array(data=band, mask=mask) for band in bands])])
+    finally:
+        blocks.close()      # Stop the reading thread or the pool
+        writer.close()
+
+def _put(queue, item, stop):
+    '''
+    Put the item into the queue, wait while the queue is full and the stop event isn't set.
+    Return False if the item isn't put.
+    '''
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def prefetch(iterable, depth=2):
+    '''
+    Generate the items of the iterable, the next items are produced by a background thread
+    while the current item is processed. For example, blocks of raster are read ahead:
+        for row, col, blocks in prefetch(raster.iterBlocks()):
+            ...
+    @param iterable     Iterable of the items (generator of the raster blocks for example).
+    @param depth        Count of the items that are produced ahead.
+    '''
+    items = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(items, (True, item), stop):
+                    return
+        except Exception as error:
+            _put(items, (False, error), stop)
+        else:
+            _put(items, (False, None), stop)    # End of the items
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if ok:
+                yield item
+            elif item is None:
+                return
+            else:
+                raise item
+    finally:
+        stop.set()      # The consumer is stopped (may be by an exception), stop the producer too
+        thread.join()
+
+
+class ThreadedWriter(object):
+    '''
+    Writes the blocks via the writer (see dataprovider.RasterWriter) in a background thread,
+    so the next blocks are computed while the previous blocks are written.
+    Usage is the same as the usage of the writer:
+        writer = ThreadedWriter(RasterWriter(filename, geodata, bandcount, rastertype))
+        for row, col, blocks in blockGenerator:
+            writer.write(1, row, col, blocks[0])
+        writer.close()
+    The blocks must not be changed after the writing.
+    '''
+    def __init__(self, writer, depth=4):
+        '''
+        @param writer       Writer of the blocks, it has methods write(bandNo, row, col, block) and close().
+        @param depth        Count of the blocks in the queue, the writing waits if the queue is full.
+        '''
+        self.writer = writer
+        self.queue = Queue.Queue(depth)
+        self.error = None       # The first exception of the writer
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            args = self.queue.get()
+            if args is None:
+                return
+            if self.error is None:  # The blocks are skipped after an error
+                try:
+                    self.writer.write(*args)
+                except Exception as error:
+                    self.error = error
+
+    def close(self):
+        '''
+        Wait for the writing of the queued blocks and close the writer.
+        '''
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+    def write(self, bandNo, row, col, block):
+        '''
+        Queue the block for writing (see RasterWriter.write).
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((bandNo, row, col, block))
+
+    def writeBlocks(self, blocks):
+        '''
+        Queue the blocks of the bands for writing (see RasterWriter.writeBlocks).
+        '''
+        for row, col, bands in blocks:
+            for i, block in enumerate(bands):
+                self.write(i+1, row, col, block)
@@ -0,0 +1,120 @@
+# encoding: utf-8
+
+'''
+Benchmarks of the array utilites: the current implementations are compared with
+the reference (pixel-by-pixel) implementations.
+
+Usage:
+    python benchmarks.py [size1 size2 ...]
+where sizeN are the side lengths of the test rasters.
+'''
+
+import sys
+from time import clock
+sys.path.insert(0, '../../../')
+
+import numpy as np
+from numpy import ma as ma
+
+from molusce.algorithms.utils import binaryzation, pack_mask, reclass, top_indexes
+
+
+SIZES = [100, 500, 1000, 2000]
+
+
+def reference_binaryzation(raster, trueList):
+    f = np.vectorize(lambda x: True if x in trueList else False )
+    return f(raster)
+
+
+def reference_reclass(X, bins):
+    def findClass(x):
+        try:
+            m = max([t for t in bins if t<=x])
+            result = bins.index(m) + 2
+        except ValueError:
+            return 1
+        return result
+    f = np.vectorize(findClass)
+    return f(X)
+
+
+def reference_top_indexes(values, n):
+    values = values.copy()
+    indexes = []
+    for i in range(n):
+        index = values.argmax()
+        indexes.append(index)
+        values[index] = -1
+    return sorted(indexes)
+
+
+def timeit(func, *args):
+    start = clock()
+    result = func(*args)
+    return clock() - start, result
+
+
+def bench_binaryzation(sizes):
+    print 'binaryzation'
+    print '%10s %10s %8s %12s %12s %8s %12s' % ('size', 'dtype', 'values', 'reference', 'current', 'speedup', 'packed, KB')
+    for size in sizes:
+        raster = np.random.randint(0, 20, (size, size))
+        raster = ma.array(data=raster, mask=(raster==0))
+        for dtype in [np.uint8, np.int32, np.float32]:
+            for trueList in [[1, 2], range(1, 10)]:
+                r = raster.astype(dtype)
+                ref, refResult = timeit(reference_binaryzation, r, trueList)
+                cur, curResult = timeit(binaryzation, r, trueList)
+                if not np.array_equal(refResult, curResult):
+                    raise Exception('Results of the implementations are different!')
+                print '%10s %10s %8s %12.4f %12.4f %8.1f %12.1f' % (
+                    size, np.dtype(dtype).name, len(trueList), ref, cur, ref/max(cur, 1e-6),
+                    len(pack_mask(curResult))/1024.0
+                )
+    print
+
+
+def bench_reclass(sizes):
+    print 'reclass'
+    print '%10s %10s %8s %12s %12s %8s' % ('size', 'dtype', 'bins', 'reference', 'current', 'speedup')
+    for size in sizes:
+        raster = np.random.random_integers(0, 1000, (size, size))
+        for dtype in [np.uint16, np.float32]:
+            for bins in [[100, 500], range(0, 1000, 50)]:
+                r = raster.astype(dtype)
+                ref, refResult = timeit(reference_reclass, r, bins)
+                cur, curResult = timeit(reclass, r, bins)
+                if not np.array_equal(refResult, curResult):
+                    raise Exception('Results of the implementations are different!')
+                print '%10s %10s %8s %12.4f %12.4f %8.1f' % (
+                    size, np.dtype(dtype).name, len(bins), ref, cur, ref/max(cur, 1e-6)
+                )
+    print
+
+
+def bench_top_indexes(sizes):
+    print 'top_indexes'
+    print '%10s %10s %12s %12s %8s' % ('size', 'n', 'reference', 'current', 'speedup')
+    for size in sizes:
+        values = np.random.random((size*size, )).astype(np.float32)
+        for n in [10, size]:
+            ref, refResult = timeit(reference_top_indexes, values, n)
+            cur, curResult = timeit(top_indexes, values, n)
+            if not np.array_equal(refResult, curResult):
+                raise Exception('Results of the implementations are different!')
+            print '%10s %10s %12.4f %12.4f %8.1f' % (
+                size, n, ref, cur, ref/max(cur, 1e-6)
+            )
+    print
+
+
+def main(sizes):
+    bench_binaryzation(sizes)
+    bench_reclass(sizes)
+    bench_top_indexes(sizes)
+
+
+if __name__=="__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or SIZES
+    main(sizes)
@@ -44,6 +44,12 @@ class TestAreaAnalysisManager (unittest.TestCase):
         raster = aa.getChangeMap()  
         band = raster.getBand(1)
         assert_array_equal(band, self.r2r2)
+
+        # The bands of lazy rasters are read by blocks
+        lazy = Raster('../../examples/multifact.tif', lazy=True)
+        aa = AreaAnalyst(lazy, lazy)
+        assert_array_equal(aa.getChangeMap().getBand(1), self.r1r1)
+        self.assertEqual(lazy.bands, [None])
     
     def test_encode(self):
         aa = AreaAnalyst(self.r1, self.r1)
@@ -55,6 +61,13 @@ class TestAreaAnalysisManager (unittest.TestCase):
                 self.assertEqual(aa.decode(k), (initClass, finalClass))
         self.assertEqual(aa.finalCodes(0), [0,1,2,3])
         self.assertEqual(aa.finalCodes(1), [4,5,6,7])
+
+        initial = np.array([[0, 1], [2, 3]])
+        final   = np.array([[3, 1], [0, 2]])
+        codes = aa.encodeArrays(initial, final)
+        for i in range(2):
+            for j in range(2):
+                self.assertEqual(codes[i, j], aa.encode(initial[i, j], final[i, j]))
         
         
 if __name__ == "__main__":
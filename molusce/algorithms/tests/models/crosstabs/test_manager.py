@@ -41,5 +41,11 @@ class TestCrossTableManager(unittest.TestCase):
         np.testing.assert_almost_equal(finalArea, stat['final'])
 
 
+    def test_lazy(self):
+        table = CrossTableManager(self.init, self.final)
+        lazyTable = CrossTableManager(Raster('../../examples/init.tif', lazy=True), Raster('../../examples/final.tif', lazy=True))
+        np.testing.assert_array_equal(table.getCrosstable().T, lazyTable.getCrosstable().T)
+        np.testing.assert_array_equal(table.getCrosstable().graduation_x, lazyTable.getCrosstable().graduation_x)
+
 if __name__ == "__main__":
     unittest.main()
@@ -53,6 +53,22 @@ class TestCrossTable (unittest.TestCase):
         self.assertEqual(r, self.r, mess)
         self.assertEqual(s, self.s, mess)
 
+    def test_update(self):
+        # Crosstable accumulated block by block
+        table = CrossTable(self.X[:1], self.Y[:1])
+        table.update(self.X[1:2], self.Y[1:2])
+        table.update(self.X[2:], self.Y[2:])
+        np.testing.assert_array_equal(table.getCrosstable(), self.T)
+        self.assertEqual(table.n, self.total)
+        self.assertEqual(table.shape, (self.r, self.s))
+        self.assertEqual(table.graduation_x, [1, 2])
+        self.assertEqual(table.graduation_y, [1, 2, 3])
+
+        # Empty (fully masked) block
+        X = np.ma.array(self.X[2:], mask=True)
+        table.update(X, self.Y[2:])
+        np.testing.assert_array_equal(table.getCrosstable(), self.T)
+
     def test_getTransition(self):
         self.table = CrossTable(self.X, self.Y)
 
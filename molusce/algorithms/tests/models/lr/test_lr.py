@@ -3,13 +3,17 @@
 import sys
 sys.path.insert(0, '../../../../../')
 
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 from molusce.algorithms.dataprovider import Raster
 from molusce.algorithms.models.lr.lr import LR
+from molusce.algorithms.models.sampler.sampler import Sampler
+from molusce.algorithms.utils import dilate
 
 
 
@@ -60,5 +64,68 @@ class TestLRManager (unittest.TestCase):
         result = np.ma.array(data = data, mask = (data==0))
         assert_array_equal(predict, result)
 
+    def test_confidence(self):
+        lr = LR(ns=0)
+        lr.setTrainingData(self.state, self.factors, self.output)
+        lr.train()
+        predict = lr.getPrediction(self.state, self.factors).getBand(1)
+        confidence = lr.getConfidence().getBand(1)
+        assert_array_equal(confidence.mask, predict.mask)
+
+        sampler = Sampler(self.state, self.factors, ns=0)
+        for i, j in zip(*np.nonzero(~predict.mask)):
+            input = sampler.get_inputs(self.state, self.factors, i, j)
+            proba = np.sort(lr.logreg.predict_proba([input])[0])
+            self.assertAlmostEqual(confidence[i, j], proba[-1] - proba[-2])
+            self.assertEqual(predict[i, j], lr.logreg.predict([input])[0])
+
+    def test_processes(self):
+        lr = LR(ns=1)
+        lr.setTrainingData(self.state1, self.factors1, self.output1)
+        lr.train()
+        predict = lr.getPrediction(self.state1, self.factors1).getBand(1)
+        confidence = lr.getConfidence().getBand(1)
+
+        # The prediction doesn't depend on the count of processes
+        lr = LR(ns=1, logreg=lr.logreg, processes=2)
+        assert_array_equal(lr.getPrediction(self.state1, self.factors1).getBand(1), predict)
+        assert_array_equal(lr.getConfidence().getBand(1), confidence)
+
+    def test_updatePrediction(self):
+        lr = LR(ns=1)
+        lr.setTrainingData(self.state1, self.factors1, self.output1)
+        lr.train()
+        lr.getPrediction(self.state1, self.factors1)
+
+        # Change a pixel of the state and update the prediction in its neighbourhood only
+        band = self.state1.getBand(1).copy()
+        changed = np.zeros(band.shape, dtype=np.bool)
+        changed[0, 0] = True
+        band[0, 0] = 3 - band[0, 0]
+        state = Raster()
+        state.create([band], self.state1.getGeodata())
+        predict = lr.updatePrediction(state, self.factors1, dilate(changed, lr.ns)).getBand(1)
+        confidence = lr.getConfidence().getBand(1)
+
+        full = LR(ns=1, logreg=lr.logreg)
+        assert_array_equal(predict, full.getPrediction(state, self.factors1).getBand(1))
+        assert_array_almost_equal(confidence, full.getConfidence().getBand(1))
+
+        # The updated blocks are written back to the memory-mapped bands
+        dirname = tempfile.mkdtemp()
+        try:
+            geodata = self.state1.getGeodata()
+            lr.getPrediction(self.state1, self.factors1)
+            for name in ['prediction', 'confidence']:
+                mapped = Raster(scratch=dirname)
+                mapped.create([getattr(lr, name).getBand(1)], geodata)
+                setattr(lr, name, mapped)
+            predict = lr.updatePrediction(state, self.factors1, dilate(changed, lr.ns)).getBand(1)
+            assert_array_equal(predict, full.getPrediction(state, self.factors1).getBand(1))
+            assert_array_almost_equal(lr.getConfidence().getBand(1), full.getConfidence().getBand(1))
+            lr.prediction = lr.confidence = mapped = None
+        finally:
+            shutil.rmtree(dirname)
+
 if __name__ == "__main__":
     unittest.main()
@@ -6,10 +6,11 @@ sys.path.insert(0, '../../../../../')
 import unittest
 
 import numpy as np
-from numpy.testing import assert_almost_equal
+from numpy.testing import assert_almost_equal, assert_array_equal
 
 from molusce.algorithms.dataprovider import Raster
 from molusce.algorithms.models.area_analysis.manager import AreaAnalyst
+from molusce.algorithms.models.mce import mce as mce_module
 from molusce.algorithms.models.mce.mce import MCE
 
 
@@ -68,5 +69,35 @@ class TestMCE(unittest.TestCase):
         answer = np.ma.array(data = answer, mask = mask)
         assert_almost_equal(c, answer)
 
+    def test_updatePrediction(self):
+        data = [
+            [1.0,     4.0, 6.0, 7.0],
+            [1.0/4,   1.0, 3.0, 4.0],
+            [1.0/6, 1.0/3, 1.0, 2.0],
+            [1.0/7, 1.0/4, 1.0/2, 1]
+        ]
+        factors = [self.factor, Raster('../../examples/two_band.tif'), self.factor]
+        mce = MCE(factors, data, 1, 2)
+        mce.getPrediction(self.state)
+
+        # Change a pixel of the state and update the prediction of its block of rows only
+        band = self.state.getBand(1).copy()
+        changed = np.zeros(band.shape, dtype=np.bool)
+        changed[1, 0] = True
+        band[1, 0] = 2
+        state = Raster()
+        state.create([band], self.state.getGeodata())
+        chunkSize = mce_module.CHUNK_SIZE
+        mce_module.CHUNK_SIZE = 12      # Blocks of one row
+        try:
+            predict = mce.updatePrediction(state, None, changed).getBand(1)
+        finally:
+            mce_module.CHUNK_SIZE = chunkSize
+        confidence = mce.getConfidence().getBand(1)
+
+        full = MCE(factors, data, 1, 2)
+        assert_array_equal(predict, full.getPrediction(state).getBand(1))
+        assert_almost_equal(confidence, full.getConfidence().getBand(1))
+
 if __name__ == "__main__":
     unittest.main()
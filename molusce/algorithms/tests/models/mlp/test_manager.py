@@ -148,6 +148,45 @@ class TestMlpManager (unittest.TestCase):
         self.assertTrue(not all(mask.flatten()))
         
 
+    def test_train_batch(self):
+        mng = MlpManager()
+        mng.createMlp(self.output, self.factors, self.output, [10])
+        mng.setTrainingData(self.output, self.factors, self.output, shuffle=False)
+        data = mng.getDataMatrix()
+        self.assertEqual(data.shape, (9, 5))
+        assert_array_equal(data[:, 2:], mng.data['output'])
+
+        # A batch of one sample is equivalent to online training
+        weights = mng.copyWeights()
+        mng.getOutput(data[0, :2])
+        mng.MLP.propagate_backward(data[0, 2:], 0.1, 0.01)
+        online = mng.copyWeights()
+        mng.setMlpWeights(weights)
+        mng.MLP.dw = [0,]*len(weights)
+        mng.MLP.train_batch(data[:1, :2], data[:1, 2:], 0.1, 0.01)
+        for w1, w2 in zip(online, mng.copyWeights()):
+            assert_allclose(w1, w2)
+
+        mng.train(1, valPercent=50, batch_size=3)
+        val = mng.getMinValError()
+        mng.train(20, valPercent=50, continue_train=True, batch_size=3)
+        self.assertGreaterEqual(val, mng.getMinValError())
+
+    def test_computePerformance(self):
+        mng = MlpManager()
+        mng.createMlp(self.output, self.factors, self.output, [10])
+        mng.setTrainingData(self.output, self.factors, self.output)
+
+        errors = [mng.computeMlpError(sample) for sample in mng.data]
+        mng.computePerformance((0, 6), (6, 9))
+        assert_allclose(mng.getTrainError(), np.mean(errors[:6]))
+        assert_allclose(mng.getValError(), np.mean(errors[6:]))
+
+        # Subset of the samples
+        assert_allclose(mng.computeSetError(np.array([1, 4, 5])), np.mean([errors[1], errors[4], errors[5]]))
+
+        mng.train(2, valPercent=20, train_error_samples=3)
+
     def test_predict(self):
         mng = MlpManager()
         mng.createMlp(self.output, self.factors, self.output, [10])
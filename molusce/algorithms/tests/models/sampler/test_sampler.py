@@ -9,7 +9,7 @@ import numpy as np
 from numpy.testing import assert_array_equal
 
 from molusce.algorithms.dataprovider import Raster
-from molusce.algorithms.models.sampler.sampler import Sampler
+from molusce.algorithms.models.sampler.sampler import Sampler, SamplerError
 
 
 class TestSample (unittest.TestCase):
@@ -21,6 +21,24 @@ class TestSample (unittest.TestCase):
         self.factors3 = [Raster('../../examples/two_band.tif')]
         self.factors4 = [Raster('../../examples/two_band.tif'), Raster('../../examples/multifact.tif')]
         
+    def test_get_inputs_block(self):
+        smp = Sampler(self.output, self.factors4, ns=1)
+        inputs, valid = smp.get_inputs_block(self.output, self.factors4, 0, 3)
+        answer = [
+            [False, False, False],
+            [False, True,  False],
+            [False, False, False]
+        ]
+        assert_array_equal(valid, answer)
+        self.assertEqual(inputs.shape, (9, 36))
+        assert_array_equal(inputs[4], smp.get_inputs(self.output, self.factors4, 1, 1))
+
+        # Block of one row
+        smp = Sampler(self.output, self.factors3, ns=0)
+        inputs, valid = smp.get_inputs_block(self.output, self.factors3, 1, 2)
+        assert_array_equal(valid, [[True, True, True]])
+        assert_array_equal(inputs, [[1, 1, 3], [2, 2, 2], [1, 1, 1]])
+
     def test_setTrainingData(self):
         smp = Sampler(self.output, self.factors,  self.output, ns=0)
         smp.setTrainingData(self.output, self.factors, self.output, shuffle=False)
@@ -124,7 +142,20 @@ class TestSample (unittest.TestCase):
         self.assertEqual(out[5],  1)
         self.assertEqual(out[9],  1)
         self.assertEqual(out[10], 2)
-        
-        
+
+    def test_setTrainingData_seed(self):
+        smp = Sampler(self.output, self.factors, self.output, ns=0)
+        smp.setTrainingData(self.output, self.factors, self.output, mode='Normal', samples=20, seed=1)
+        data = smp.data.copy()
+        smp.setTrainingData(self.output, self.factors, self.output, mode='Normal', samples=20, seed=1)
+        assert_array_equal(data, smp.data)
+
+        # Without replacement every pixel is sampled once
+        smp.setTrainingData(self.output, self.factors, self.output, mode='Normal', samples=9, replace=False, seed=1)
+        assert_array_equal(np.sort(smp.data['output']), np.sort(self.output.getBand(1).flatten()))
+        self.assertRaises(SamplerError, smp.setTrainingData, self.output, self.factors, self.output,
+            mode='Normal', samples=10, replace=False)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,110 @@
+# encoding: utf-8
+
+import sys
+sys.path.insert(0, '../../../../../')
+
+import os
+import threading
+import unittest
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+import numpy as np
+from numpy import ma as ma
+
+from molusce.algorithms.models.crosstabs.manager  import CrossTableManager
+from molusce.algorithms.dataprovider import Raster
+from molusce.algorithms.models.simulator.sim import Simulator
+from molusce.algorithms.models.simulator.ensemble import Ensemble, EnsembleError
+
+from test_sim import Model
+
+
+class TestEnsemble(unittest.TestCase):
+
+    def setUp(self):
+        self.raster1 = Raster('../../examples/multifact.tif')
+        self.raster1.resetMask([0])
+
+        self.X = np.array([
+            [1, 2, 3],
+            [3, 2, 1],
+            [0, 1, 1]
+        ])
+        self.X = np.ma.array(self.X, mask=(self.X == 0))
+        self.raster2 = Raster()
+        self.raster2.create([self.X], self.raster1.getGeodata())
+
+        self.crosstab = CrossTableManager(self.raster1, self.raster2)
+        self.model = Model(self.raster1)
+
+    def test_stochastic(self):
+        states = []
+        for seed in [1, 1, 2]:
+            simulator = Simulator(self.raster1, None, self.model, self.crosstab, stochastic=True, seed=seed)
+            simulator.sim()
+            states.append(simulator.getState().getBand(1))
+        assert_array_equal(states[0], states[1])
+
+        # The count of the transitions doesn't depend on the allocation
+        simulator = Simulator(self.raster1, None, self.model, self.crosstab)
+        simulator.sim()
+        state = simulator.getState().getBand(1)
+        initial = self.raster1.getBand(1)
+        for s in states:
+            assert_array_equal(s.mask, initial.mask)
+            self.assertEqual(np.sum(s != initial), np.sum(state != initial))
+
+    def test_run(self):
+        results = []
+        for processes in [1, 2]:
+            ensemble = Ensemble(self.raster1, None, self.model, self.crosstab, processes=processes)
+            ensemble.run(10, iterations=2, seed=1)
+            results.append((ensemble.getFrequency().getBand(1), ensemble.getProbability()))
+        # The result doesn't depend on the count of the processes
+        assert_array_equal(results[0][0], results[1][0])
+        for i in range(3):
+            assert_array_equal(results[0][1].getBand(i+1), results[1][1].getBand(i+1))
+
+        frequency, probability = results[0]
+        initial = self.raster1.getBand(1)
+        assert_array_equal(frequency.mask, initial.mask)
+        total = sum(probability.getBand(i+1) for i in range(3))
+        assert_array_almost_equal(total, np.ones(initial.shape))
+        for i, cl in enumerate(ensemble.classes):
+            # Frequency of the transitions is probability of the other classes
+            p = probability.getBand(i+1)
+            assert_array_almost_equal(frequency[initial == cl], 1 - p[initial == cl])
+
+        ensemble = Ensemble(self.raster1, None, self.model, self.crosstab)
+        self.assertRaises(EnsembleError, ensemble.getFrequency)
+        self.assertRaises(EnsembleError, ensemble.run, 0)
+
+    def test_save(self):
+        ensemble = Ensemble(self.raster1, None, self.model, self.crosstab, processes=1)
+        ensemble.run(3, seed=1)
+        try:
+            frequencyFile, probabilityFile = 'frequency.tiff', 'probability.tiff'
+            ensemble.save(frequencyFile, probabilityFile)
+            frequency = Raster(frequencyFile)
+            assert_array_equal(frequency.getBand(1), ensemble.getFrequency().getBand(1))
+            probability = Raster(probabilityFile)
+            self.assertEqual(probability.getBandsCount(), 3)
+            for i in range(3):
+                assert_array_equal(probability.getBand(i+1), ensemble.getProbability().getBand(i+1))
+        finally:
+            os.remove(frequencyFile)
+            os.remove(probabilityFile)
+
+        # The writers are closed if the saving fails
+        ensemble = Ensemble(self.raster1, None, self.model, self.crosstab)
+        threads = threading.active_count()
+        try:
+            self.assertRaises(EnsembleError, ensemble.save, frequencyFile, probabilityFile)
+            self.assertEqual(threading.active_count(), threads)
+        finally:
+            os.remove(frequencyFile)
+            os.remove(probabilityFile)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,7 +12,7 @@ from numpy import ma as ma
 from molusce.algorithms.models.crosstabs.manager  import CrossTableManager
 from molusce.algorithms.models.area_analysis.manager import AreaAnalyst
 from molusce.algorithms.dataprovider import Raster
-from molusce.algorithms.models.simulator.sim import Simulator
+from molusce.algorithms.models.simulator.sim import Simulator, SimulatorError
 
 
 class Model(object):
@@ -125,5 +125,11 @@ class TestSimulator(unittest.TestCase):
         assert_array_equal(result, state)
     
     
+    def test_unknown_class(self):
+        simulator = Simulator(self.raster1, None, self.model, self.crosstab)
+        prediction = simulator.getPrediction().getBand(1)
+        prediction[0, 0] = 4    # The class is not in the initial state
+        self.assertRaises(SimulatorError, simulator.sim)
+
 if __name__ == "__main__":
     unittest.main()
@@ -10,6 +10,7 @@ import numpy as np
 from numpy import ma as ma
 
 from molusce.algorithms.dataprovider import Raster
+from molusce.algorithms.models.woe import manager
 from molusce.algorithms.models.woe.manager import WoeManager
 from molusce.algorithms.models.woe.model import woe
 from molusce.algorithms.models.area_analysis.manager import AreaAnalyst
@@ -137,8 +138,41 @@ class TestWoEManager (unittest.TestCase):
         ]
         assert_array_equal(p, answer)
 
+        # Confidence is the difference of the sigmoids of the biggest and the second biggest weights
+        c = w.getConfidence().getBand(1)
+        assert_array_equal(c.mask, p.mask)
+        weights = sorted([w.getWoe()[code][0, 0] for code in aa.codes(1)])
+        sigmoid = lambda x: 1/(1+np.exp(-x))
+        self.assertAlmostEqual(c[0, 0], sigmoid(weights[-1]) - sigmoid(weights[-2]))
+
         w = WoeManager([initState], aa, bins = {0: [[2], ],})
         p = w.getPrediction(initState).getBand(1)
     
+    def test_updatePrediction(self):
+        initState = Raster('../../examples/data.tif')
+        finalState = Raster('../../examples/data1.tif')
+        aa = AreaAnalyst(initState, finalState)
+        w = WoeManager([initState], aa)
+        w.getPrediction(initState)
+
+        # Change a pixel of the state and update the prediction of its block of rows only
+        band = initState.getBand(1).copy()
+        changed = np.zeros(band.shape, dtype=np.bool)
+        changed[1, 2] = True
+        band[1, 2] = 3 if band[1, 2] != 3 else 1
+        state = Raster()
+        state.create([band], initState.getGeodata())
+        chunkSize = manager.CHUNK_SIZE
+        manager.CHUNK_SIZE = 12     # Blocks of one row
+        try:
+            predict = w.updatePrediction(state, None, changed).getBand(1)
+        finally:
+            manager.CHUNK_SIZE = chunkSize
+        confidence = w.getConfidence().getBand(1)
+
+        full = WoeManager([initState], aa)
+        assert_array_equal(predict, full.getPrediction(state).getBand(1))
+        assert_array_equal(confidence, full.getConfidence().getBand(1))
+
 if __name__ == "__main__":
     unittest.main()
@@ -9,7 +9,8 @@ import numpy as np
 from numpy import ma as ma
 
 
-from molusce.algorithms.models.woe.model import WoeError, _binary_woe, woe, EPSILON
+from molusce.algorithms.models.woe.model import WoeError, _binary_woe, woe, woe_codes, EPSILON
+from molusce.algorithms.utils import binaryzation
 
 
 class TestModel (unittest.TestCase):
@@ -142,6 +143,16 @@ class TestModel (unittest.TestCase):
         weights = woe(self.multifact, self.sites)
         
         np.testing.assert_equal(ans, weights)
+
+    def test_woe_codes(self):
+        weights = woe_codes(self.multifact, self.sites2, [1, 2])
+        self.assertEqual(sorted(weights.keys()), [1, 2])
+        for code in [1, 2]:
+            np.testing.assert_equal(weights[code], woe(self.multifact, binaryzation(self.sites2, [code])))
+
+        # The sites of the code are absent
+        self.assertRaises(WoeError, woe_codes, self.multifact, self.sites2, [3])
+        self.assertRaises(WoeError, woe_codes, self.multifact, self.sites2+1, [1])
         
         
         
@@ -2,6 +2,9 @@
 
 import sys
 import os
+import pickle
+import shutil
+import tempfile
 sys.path.insert(0, '../../../')
 
 import unittest
@@ -9,7 +12,10 @@ from numpy.testing import assert_array_equal
 import numpy as np
 from numpy import ma as ma
 
-from molusce.algorithms.dataprovider import Raster, ProviderError
+from osgeo import gdal
+
+from molusce.algorithms.dataprovider import Raster, RasterWriter, FormatConverter, ProviderError
+from molusce.algorithms.parallel import imap
 
 class TestRaster (unittest.TestCase):
     def setUp(self):
@@ -56,10 +62,118 @@ class TestRaster (unittest.TestCase):
         self.assertTrue(self.r1.isMetricProj())
 
 
+    def test_lazy(self):
+        r = Raster('examples/two_band.tif', lazy=True)
+        self.assertEqual(r.getBandsCount(), 2)
+        self.assertEqual(r.bands, [None, None])
+        assert_array_equal(r.getBlock(2, 1, 1, 2, 2), self.r3.getBand(2)[1:3, 1:3])
+
+        # Blocks cover the raster
+        result = [ma.zeros((r.getYSize(), r.getXSize())) for i in range(2)]
+        for row, col, blocks in r.iterBlocks(pixels=1):
+            for i, block in enumerate(blocks):
+                height, width = block.shape
+                result[i][row:row+height, col:col+width] = block
+        for i in range(2):
+            assert_array_equal(result[i], self.r3.getBand(i+1))
+
+        assert_array_equal(r.getBand(1), self.r3.getBand(1))
+        self.assertTrue(r.bands[0] is not None)
+        self.assertTrue(r.bands[1] is None)
+
+    def test_lazy_processes(self):
+        # The worker processes read the rows of the lazy raster at once via their own datasets
+        eager = Raster('examples/init.tif')
+        r = Raster('examples/init.tif', lazy=True)
+        rows, cols = r.getYSize(), r.getXSize()
+        def readRow(row):
+            return row, r.getBlock(1, row, 0, 1, cols), r.pid == os.getpid()
+        count = 0
+        for row, block, reopened in imap(readRow, [(i, ) for i in range(rows)], 4):
+            assert_array_equal(block, eager.getBlock(1, row, 0, 1, cols))
+            self.assertTrue(reopened)
+            count += 1
+        self.assertEqual(count, rows)
+        self.assertEqual(r.pid, os.getpid())
+
+    def test_memmap(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            r = Raster('examples/two_band.tif', scratch=dirname)
+            for i in range(1, 3):
+                self.assertTrue(isinstance(r.getBand(i).data, np.memmap))
+                assert_array_equal(r.getBand(i), self.r3.getBand(i))
+            assert_array_equal(r.getBlock(2, 1, 1, 2, 2), self.r3.getBand(2)[1:3, 1:3])
+            self.assertEqual(len(os.listdir(dirname)), 4)
+
+            # The bands are shared by pickling
+            copy = pickle.loads(pickle.dumps(r))
+            assert_array_equal(copy.getBand(1), r.getBand(1))
+            self.assertEqual(copy.bands[0].dataFile, r.bands[0].dataFile)
+
+            band = ma.array(data=[[1, 2, 3], [4, 5, 6], [7, 8, 9]], mask=[[0, 0, 1], [0, 1, 0], [1, 0, 0]])
+            r.setBand(band, 1)
+            assert_array_equal(r.getBand(1), band)
+            assert_array_equal(r.getBand(1).mask, band.mask)
+            assert_array_equal(r.getBlock(1, 1, 0, 2, 2).mask, band.mask[1:3, 0:2])
+
+            # The data and the mask of the block are stored
+            block = ma.array(data=[[10, 11], [12, 13]], mask=[[1, 0], [0, 0]])
+            r.setBlock(1, 1, 1, block)
+            band[1:3, 1:3] = block
+            assert_array_equal(r.getBand(1), band)
+            assert_array_equal(r.getBand(1).mask, band.mask)
+
+            del copy
+            del r
+            self.assertEqual(os.listdir(dirname), [])
+        finally:
+            shutil.rmtree(dirname)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'The platform does not support fork')
+    def test_memmap_fork(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            r = Raster('examples/two_band.tif', scratch=dirname)
+            # Forked process doesn't remove the files of the parent
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    r.bands[1] = None    # The band is deleted in the child process
+                    status = 0
+                finally:
+                    os._exit(status)    # The child never returns to the test runner
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertEqual(len(os.listdir(dirname)), 4)
+            assert_array_equal(r.getBand(2), self.r3.getBand(2))
+
+            del r
+            self.assertEqual(os.listdir(dirname), [])
+        finally:
+            shutil.rmtree(dirname)
+
     def test_getBandStat(self):
         stat = self.r1.getBandStat(1)
         self.assertAlmostEqual(stat['mean'], 15.0/9)
         self.assertAlmostEqual(stat['std'], np.sqrt(10.0/9))
+        self.assertEqual(stat['gradation'], [0, 1, 2, 3])
+        self.assertEqual(stat['min'], 0)
+        self.assertEqual(stat['max'], 3)
+
+        # Gradation on request and the cap of the gradation length
+        self.assertFalse('gradation' in self.r1.getBandStat(1, gradation=False))
+        self.assertEqual(self.r1.getBandStat(1, maxGradations=3)['gradation'], None)
+        self.assertEqual(self.r1.getBandStat(1, maxGradations=4)['gradation'], [0, 1, 2, 3])
+
+        # The statistic is cached until the band is changed
+        self.assertTrue(1 in self.r1.statCache)
+        self.r1.setBand(self.r1.getBand(1)*2, 1)
+        self.assertFalse(1 in self.r1.statCache)
+        self.assertAlmostEqual(self.r1.getBandStat(1)['mean'], 30.0/9)
+
+        r = Raster('examples/multifact.tif', lazy=True)
+        self.assertAlmostEqual(r.getBandStat(1)['std'], np.sqrt(10.0/9))
 
     def test_normalize(self):
         multifact = [
@@ -92,6 +206,43 @@ class TestRaster (unittest.TestCase):
         r1.denormalize()
         assert_array_equal(r1.getBand(1), multifact)
 
+        # Band with nonzero minimum
+        band = ma.array(data=np.array(multifact) + 10, mask=np.zeros((3, 3)))
+        r = Raster()
+        r.create([band], self.r1.getGeodata())
+        r.normalize(mode='maxmin')
+        assert_array_equal(r.getBand(1), (np.array(multifact) - 0)/3.0)
+        normalized = r.getBand(1)
+        r.normalize(mode='maxmin')      # Normalization is idempotent
+        self.assertTrue(r.getBand(1) is normalized)
+        r.normalize()
+        self.assertTrue(r.getBand(1) is normalized)   # The band is changed in-place
+        r.denormalize()
+        assert_array_equal(r.getBand(1), band)
+        assert_array_equal(band, np.array(multifact) + 10)    # The initial array isn't changed
+
+        r = Raster('examples/multifact.tif')
+        r.normalize(dtype=np.float32)
+        self.assertEqual(r.getBand(1).dtype, np.float32)
+        self.assertAlmostEqual(r.getBand(1).mean(), 0, places=6)
+        # The float32 band isn't copied (and converted) by the switching of the modes
+        normalized = r.getBand(1)
+        r.normalize(mode='maxmin')
+        r.normalize()
+        self.assertTrue(r.getBand(1) is normalized)
+        self.assertEqual(r.getBand(1).dtype, np.float32)
+        self.assertRaises(ProviderError, r.normalize, mode='unknown')
+
+        # Float32 band keeps its dtype
+        r = Raster()
+        r.create([ma.array(data=np.array(multifact, dtype=np.float32), mask=np.zeros((3, 3)))], self.r1.getGeodata())
+        r.normalize()
+        normalized = r.getBand(1)
+        self.assertEqual(normalized.dtype, np.float32)
+        r.normalize(mode='maxmin')
+        r.normalize()
+        self.assertTrue(r.getBand(1) is normalized)
+
 
     def test_getNeighbours(self):
         neighbours = self.r2.getNeighbours(row=1,col=0, size=0)
@@ -123,6 +274,41 @@ class TestRaster (unittest.TestCase):
             self.assertEqual(r2.getBandsCount(), self.r1.getBandsCount())
             for i in range(r2.getBandsCount()):
                 assert_array_equal(r2.getBand(i+1), self.r1.getBand(i+1))
+            # NoData value 0 is masked
+            assert_array_equal(r2.getBand(1).mask, self.r1.getBand(1).data == 0)
+        finally:
+            os.remove(filename)
+
+    def test_FormatConverter(self):
+        conv = FormatConverter()
+        self.assertEqual(conv.getRasterType(np.uint8), gdal.GDT_Byte)
+        self.assertEqual(conv.getRasterType(np.float32), gdal.GDT_Float32)
+        if not hasattr(gdal, 'GDT_Int64'):
+            # 64-bit integers are saved without loss if the values fit smaller type
+            self.assertEqual(conv.getRasterType(np.int64, -1, 1000), gdal.GDT_Int16)
+            self.assertEqual(conv.getRasterType(np.int64, 0, 70000), gdal.GDT_UInt32)
+            self.assertRaises(ProviderError, conv.getRasterType, np.int64, 0, 2**40)
+            self.assertRaises(ProviderError, conv.getRasterType, np.int64)
+
+    def test_RasterWriter(self):
+        try:
+            filename = 'temp.tiff'
+            options = RasterWriter.gtiffOptions(gdal.GDT_Int16, blockSize=16)
+            self.assertTrue('PREDICTOR=2' in options)
+            self.r3.save(filename, rastertype=gdal.GDT_Int16, options=options)
+            r = Raster(filename)
+            for i in range(1, 3):
+                assert_array_equal(r.getBand(i), self.r3.getBand(i))
+
+            # Write the masked blocks
+            writer = RasterWriter(filename, self.r1.getGeodata(), 1, gdal.GDT_Int16, nodata=5)
+            writer.write(1, 0, 0, ma.array(data=[[1, 2, 3]], mask=[[False, True, False]]))
+            writer.write(1, 1, 0, np.array([[4, 5, 6], [7, 8, 9]]))
+            writer.close()
+            r = Raster(filename)
+            answer = ma.array(data=[[1, 5, 3], [4, 5, 6], [7, 8, 9]], mask=[[0, 1, 0], [0, 1, 0], [0, 0, 0]])
+            assert_array_equal(r.getBand(1), answer)
+            assert_array_equal(r.getBand(1).mask, answer.mask)
         finally:
             os.remove(filename)
 
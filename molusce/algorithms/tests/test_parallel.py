@@ -0,0 +1,119 @@
+# encoding: utf-8
+
+import sys
+sys.path.insert(0, '../../../')
+
+import os
+import threading
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from molusce.algorithms.parallel import imap, predict_blocks, prefetch, ThreadedWriter
+from molusce.algorithms.dataprovider import RastersWriter
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.X = np.arange(70).reshape(10, 7)
+
+    def square(self, x):
+        return x*x
+
+    def readBlock(self, first, last):
+        return self.X[first:last]
+
+    def predictBlock(self, block):
+        return [block*2, block.astype(np.float32)/2], block % 3 == 0
+
+    def test_imap(self):
+        tasks = [(i, ) for i in range(20)]
+        for processes in [1, 4, None]:
+            result = sorted(imap(self.square, tasks, processes))
+            self.assertEqual(result, [i*i for i in range(20)])
+        # The tasks are run in the current process
+        self.assertEqual(list(imap(lambda i: os.getpid(), [(1, )])), [os.getpid()])
+        self.assertEqual(list(imap(self.square, [], 4)), [])
+
+        # The replaced workers and the concurrent pools have their own functions
+        result = sorted(imap(self.square, tasks, 2, maxtasksperchild=1))
+        self.assertEqual(result, [i*i for i in range(20)])
+        squares, negatives = imap(self.square, tasks, 2), imap(lambda i: -i, tasks, 2)
+        result = [(squares.next(), negatives.next()) for i in range(20)]
+        self.assertEqual(sorted(r[0] for r in result), [i*i for i in range(20)])
+        self.assertEqual(sorted(-r[1] for r in result), range(20))
+
+    def test_predict_blocks(self):
+        geodata = {'xSize': 7, 'ySize': 10}
+        for processes in [1, 3]:
+            for blockRows in [1, 4, 100]:
+                writer = RastersWriter(geodata, [np.int16, np.float32])
+                predict_blocks(self.readBlock, self.predictBlock, writer, 10, blockRows, processes)
+                doubled, halved = [r.getBand(1) for r in writer.rasters]
+                self.assertEqual(doubled.dtype, np.int16)
+                self.assertEqual(halved.dtype, np.float32)
+                assert_array_equal(doubled.data, self.X*2)
+                assert_array_equal(halved.data, self.X/2.0)
+                assert_array_equal(doubled.mask, self.X % 3 == 0)
+                assert_array_equal(halved.mask, self.X % 3 == 0)
+
+        # The next block is read while the current block is predicted
+        read = [threading.Event() for i in range(10)]
+        ahead = []
+        def readBlock(first, last):
+            read[first].set()
+            return self.readBlock(first, last)
+        def predictBlock(block):
+            first = block[0, 0] / 7
+            if first < 9:
+                ahead.append(read[first + 1].wait(5))
+            return self.predictBlock(block)
+        predict_blocks(readBlock, predictBlock, RastersWriter(geodata, [np.int16, np.float32]), 10, 1)
+        self.assertEqual(ahead, [True]*9)
+
+    def test_prefetch(self):
+        self.assertEqual(list(prefetch(xrange(10))), range(10))
+        self.assertEqual(list(prefetch([], depth=1)), [])
+
+        def failed():
+            yield 1
+            raise ValueError('Read error')
+        items = prefetch(failed())
+        self.assertEqual(items.next(), 1)
+        self.assertRaises(ValueError, items.next)
+
+        # The consumer stops before the end of the items
+        for i in prefetch(xrange(1000), depth=1):
+            if i == 5:
+                break
+
+    def test_ThreadedWriter(self):
+        class Writer(object):
+            def __init__(self):
+                self.blocks, self.closed = [], False
+            def write(self, bandNo, row, col, block):
+                if block is None:
+                    raise ValueError('Write error')
+                self.blocks.append((bandNo, row, col, block))
+            def close(self):
+                self.closed = True
+
+        writer = Writer()
+        threaded = ThreadedWriter(writer, depth=1)
+        threaded.writeBlocks([(i, 0, [self.X[i], -self.X[i]]) for i in range(10)])
+        threaded.close()
+        self.assertTrue(writer.closed)
+        self.assertEqual(len(writer.blocks), 20)
+        for k, (bandNo, row, col, block) in enumerate(writer.blocks):
+            self.assertEqual((bandNo, row, col), (k % 2 + 1, k / 2, 0))
+            assert_array_equal(block, self.X[row] * (1 if bandNo == 1 else -1))
+
+        # Errors of the writer are raised by the writing or closing
+        threaded = ThreadedWriter(Writer())
+        threaded.write(1, 0, 0, None)
+        self.assertRaises(ValueError, threaded.close)
+
+
+if __name__ == "__main__":
+    unittest.main()
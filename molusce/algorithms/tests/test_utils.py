@@ -8,7 +8,8 @@ import unittest
 import numpy as np
 from numpy.testing import assert_array_equal
 
-from molusce.algorithms.utils import masks_identity, sizes_equal, reclass
+from molusce.algorithms.utils import masks_identity, sizes_equal, reclass, binaryzation, pack_mask, unpack_mask
+from molusce.algorithms.utils import box_sum, window_view, class_dtype, top_indexes, dilate
 
 class TestRaster (unittest.TestCase):
     def setUp(self):
@@ -50,6 +51,39 @@ class TestRaster (unittest.TestCase):
     def test_Size_no_equals(self):
         self.assertEqual(sizes_equal(self.X2, self.Y), False, 'sizes are equal')
 
+    def test_binaryzation(self):
+        answer = np.array([
+            [True,  False, True, ],
+            [True,  False, True, ],
+            [False, True,  False,]
+        ])
+        # Masked raster: the mask must be preserved
+        X = binaryzation(self.X, [1])
+        assert_array_equal(X.data, answer)
+        assert_array_equal(X.mask, self.X.mask)
+
+        # Lookup table, direct comparison and sorted search kernels
+        answer = np.array([
+            [True,  False, True, ],
+            [True,  True,  True, ],
+            [False, True,  False,],
+            [False, True,  True, ]
+        ])
+        trueList = [-1, 1, 3, 7, 8, 9]
+        for dtype in [np.uint8, np.int16, np.int32, np.float]:
+            X = binaryzation(self.X2.astype(dtype), trueList)
+            assert_array_equal(X, answer)
+            X = binaryzation(self.X2.astype(dtype), [1, 3, 7])
+            assert_array_equal(X, answer)
+
+        X = binaryzation(self.X2, [])
+        assert_array_equal(X, np.zeros(self.X2.shape, dtype=np.bool))
+
+        # Packed mask
+        packed = pack_mask(answer)
+        self.assertEqual(len(packed), 2)
+        assert_array_equal(unpack_mask(packed, answer.shape), answer)
+
     def test_reclass(self):
         X = reclass(self.X2, [1.1, 3.1, 4])
         answer = np.array([
@@ -60,6 +94,100 @@ class TestRaster (unittest.TestCase):
         ])
         assert_array_equal(X, answer)
 
+        # Lookup table and binary search
+        for dtype in [np.uint8, np.int8, np.int16, np.float32]:
+            X = reclass(self.X2.astype(dtype), [1.1, 3.1, 4])
+            assert_array_equal(X, answer)
+
+        # The first of the equal bins defines the class
+        X = reclass(self.X2, [1, 1, 4])
+        answer = np.array([
+            [2, 2, 2,],
+            [2, 2, 2,],
+            [1, 2, 4,],
+            [1, 2, 4,]
+        ])
+        assert_array_equal(X, answer)
+
+        # Masked array, in-place reclassification
+        X = self.X.copy()
+        R = reclass(X, [1.5], out=X)
+        self.assertTrue(R is X)
+        answer = np.array([
+            [1, 2, 1,],
+            [1, 2, 1,],
+            [1, 1, 2,]
+        ])
+        assert_array_equal(X.data, answer)
+        assert_array_equal(X.mask, self.X.mask)
+        R = reclass(self.X, [1.5])
+        assert_array_equal(R.data, answer)
+        assert_array_equal(R.mask, self.X.mask)
+
+    def test_class_dtype(self):
+        self.assertEqual(class_dtype([1, 2, 3]), np.uint8)
+        self.assertEqual(class_dtype([1.0, 300.0]), np.uint16)
+        self.assertEqual(class_dtype([-1, 100]), np.int8)
+        self.assertEqual(class_dtype([-1, 200]), np.int16)
+        self.assertEqual(class_dtype([0.5, 1]), np.float64)
+        self.assertEqual(class_dtype([]), np.uint8)
+
+    def test_box_sum(self):
+        X = np.arange(20).reshape(4, 5)
+        S = box_sum(X, 1)
+        self.assertEqual(S.shape, (2, 3))
+        for i in range(2):
+            for j in range(3):
+                self.assertEqual(S[i, j], X[i:i+3, j:j+3].sum())
+        assert_array_equal(box_sum(X, 0), X)
+
+        M = np.array([
+            [False, False, False, False],
+            [False, True,  False, False],
+            [False, False, False, False]
+        ])
+        assert_array_equal(box_sum(M, 1), [[1, 1]])
+
+    def test_window_view(self):
+        X = np.arange(20).reshape(4, 5)
+        W = window_view(X, 1)
+        self.assertEqual(W.shape, (2, 3, 3, 3))
+        for i in range(2):
+            for j in range(3):
+                assert_array_equal(W[i, j], X[i:i+3, j:j+3])
+        W = window_view(X, 0)
+        assert_array_equal(W.reshape(4, 5), X)
+
+    def test_dilate(self):
+        X = np.zeros((4, 5), dtype=np.bool)
+        X[0, 0] = X[3, 3] = True
+        D = dilate(X, 1)
+        for i in range(4):
+            for j in range(5):
+                self.assertEqual(D[i, j], X[max(0, i-1):i+2, max(0, j-1):j+2].any())
+        assert_array_equal(dilate(X, 0), X)
+
+    def test_top_indexes(self):
+        X = np.array([0.5, 0.9, 0.1, 0.9, 0.5, np.nan, 0.5])
+        assert_array_equal(top_indexes(X, 0), [])
+        assert_array_equal(top_indexes(X, 1), [1])
+        assert_array_equal(top_indexes(X, 2), [1, 3])
+        # Ties: the elements with smaller indexes are selected
+        assert_array_equal(top_indexes(X, 3), [0, 1, 3])
+        assert_array_equal(top_indexes(X, 4), [0, 1, 3, 4])
+        assert_array_equal(top_indexes(X, 6), [0, 1, 2, 3, 4, 6])
+        assert_array_equal(top_indexes(X, 10), range(7))
+
+        # Compare with the sequential selection of maximums
+        X = np.random.randint(0, 10, 1000).astype(np.float32)
+        Y = X.copy()
+        indexes = []
+        for i in range(100):
+            index = Y.argmax()
+            indexes.append(index)
+            Y[index] = -1
+        assert_array_equal(top_indexes(X, 100), sorted(indexes))
+
 if __name__ == "__main__":
     unittest.main()
 
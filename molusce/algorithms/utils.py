@@ -5,6 +5,17 @@ Some array utilites
 '''
 
 import numpy as np
+from numpy import ma as ma
+from numpy.lib.stride_tricks import as_strided
+
+# Lists of SMALL_LIST or less values are tested by direct comparison
+SMALL_LIST = 4
+
+# Size (pixel count) of the chunks processed at once by the chunked functions
+CHUNK_SIZE = 2**20
+
+# dtype of the confidence rasters of the models
+CONFIDENCE_DTYPE = np.float32
 
 class UtilsError(Exception):
     '''Base class for exceptions in this module.'''
@@ -15,13 +26,134 @@ class UtilsError(Exception):
 
 def binaryzation( raster, trueList ):
     '''Raster binarization.
-    
+
+    The membership test is vectorized: small integer rasters (bool, 8 and 16 bit)
+    use a lookup table indexed by the pixel values, short lists of values
+    are compared directly, other rasters use binary search over the sorted values.
+
     @param trueList     List of raster values converted into true
-    @return raster      Binary raster
+    @return raster      Binary raster (the mask of a masked raster is preserved)
+    '''
+    data = np.asarray(ma.getdata(raster))
+    result = _membership(data, trueList)
+    if ma.isMaskedArray(raster):
+        result = ma.array(data = result, mask = ma.getmaskarray(raster), copy = True)
+    return result
+
+def _membership(data, trueList):
+    '''Return boolean array: True where the element of data is in trueList'''
+    values = np.unique(np.array(list(trueList)))
+    if len(values) == 0:
+        return np.zeros(data.shape, dtype=np.bool)
+
+    if data.dtype.kind in 'biu' and data.dtype.itemsize <= 2:
+        # Lookup table over all values of the dtype, indexed by the bit pattern of the pixel
+        codes = np.dtype('uint%s' % (8*data.dtype.itemsize))
+        lut = np.zeros(2**(8*data.dtype.itemsize), dtype=np.bool)
+        for v in values:
+            x = np.array(v).astype(data.dtype)
+            if x == v:
+                lut[x.view(codes)] = True
+        return lut[data.view(codes)]
+
+    if len(values) <= SMALL_LIST:
+        result = np.zeros(data.shape, dtype=np.bool)
+        tmp = np.empty(data.shape, dtype=np.bool)
+        for v in values:
+            np.equal(data, v, tmp)
+            result |= tmp
+        return result
+
+    # Sorted search: find position of every pixel in the sorted list of values
+    index = np.searchsorted(values, data)
+    np.clip(index, 0, len(values)-1, index)
+    return values[index] == data
+
+def pack_mask(mask):
+    '''Pack boolean array into bits (8 pixels per byte).'''
+    return np.packbits(np.asarray(mask, dtype=np.bool).ravel())
+
+def unpack_mask(packed, shape):
+    '''Unpack bits packed by pack_mask into boolean array of the given shape.'''
+    count = int(np.prod(shape))
+    return np.unpackbits(packed)[:count].view(np.bool).reshape(shape)
+
+
+def box_sum(X, ns):
+    '''Sums of the elements of the array over the moving window of (2*ns+1)x(2*ns+1) size.
+    The sums are computed via the integral image (summed area table) of X.
+    @param X        2-D array.
+    @param ns       Neighbourhood size.
+    @return         Array of (rows-2*ns, cols-2*ns) shape: result[i,j] is the sum over
+                    the neighbourhood of the element X[i+ns, j+ns].
+    '''
+    rows, cols = X.shape
+    size = 2*ns+1
+    S = np.zeros((rows+1, cols+1), dtype=np.int64 if X.dtype.kind in 'biu' else np.float)
+    np.cumsum(X, axis=0, out=S[1:, 1:])
+    np.cumsum(S[1:, 1:], axis=1, out=S[1:, 1:])
+    return S[size:, size:] - S[:-size, size:] - S[size:, :-size] + S[:-size, :-size]
+
+def dilate(X, ns):
+    '''Dilation of the boolean array by the square of (2*ns+1)x(2*ns+1) size.
+    @param X        2-D boolean array.
+    @param ns       Neighbourhood size.
+    @return         Boolean array of X shape: result[i,j] is True if the neighbourhood of X[i,j] contains True.
+    '''
+    if ns == 0:
+        return X.copy()
+    return box_sum(np.pad(X, ns, 'constant'), ns) > 0
+
+def window_view(X, ns):
+    '''Return moving window view of the array, the data is not copied.
+    @param X        2-D array.
+    @param ns       Neighbourhood size.
+    @return         Array of (rows-2*ns, cols-2*ns, 2*ns+1, 2*ns+1) shape: result[i,j] is
+                    the neighbourhood of the element X[i+ns, j+ns].
     '''
-    f = np.vectorize(lambda x: True if x in trueList else False )
-    return f(raster)
+    rows, cols = X.shape
+    size = 2*ns+1
+    s0, s1 = X.strides
+    return as_strided(X, shape=(rows-2*ns, cols-2*ns, size, size), strides=(s0, s1, s0, s1))
 
+def class_dtype(classes):
+    '''
+    Return the smallest dtype that stores the class values (and 0, the value of masked pixels) without loss:
+    unsigned integer dtype for non-negative integer classes, signed integer dtype for integer classes,
+    float64 for non-integer classes.
+    @param classes      List of the class values.
+    '''
+    values = np.append(np.asarray(classes, dtype=np.float), 0)
+    if not np.all(values == np.round(values)):
+        return np.dtype(np.float64)
+    lo, hi = values.min(), values.max()
+    if lo >= 0:
+        dtypes = [np.uint8, np.uint16, np.uint32, np.uint64]
+    else:
+        dtypes = [np.int8, np.int16, np.int32, np.int64]
+    for dtype in dtypes:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.float64)
+
+def top_indexes(values, n):
+    '''
+    Return sorted indexes of the n biggest elements of 1-D array (NaN is the smallest value).
+    The elements are selected by partial sort. Ties are broken deterministically: the element with smaller index is selected.
+    '''
+    values = np.asarray(values)
+    if n <= 0:
+        return np.zeros(0, dtype=np.int)
+    if n >= len(values):
+        return np.arange(len(values))
+    if values.dtype.kind == 'f':
+        values = np.where(np.isnan(values), -np.inf, values)
+    kth = len(values) - n
+    threshold = np.partition(values, kth)[kth]      # n-th biggest value
+    greater = np.flatnonzero(values > threshold)
+    equal = np.flatnonzero(values == threshold)[:n - len(greater)]
+    return np.union1d(greater, equal)
 
 def get_gradations(band):
     return list(np.unique(np.array(band)))
@@ -43,7 +175,7 @@ def masks_identity(X, Y):
     Y = np.ma.array(Y, mask = mask)
     return X, Y
 
-def reclass(X, bins):
+def reclass(X, bins, out=None):
         '''Reclass X to new categories.
         @param bins     List of bins (category bounds):
                 Interval         ->   New Class Number
@@ -53,21 +185,48 @@ def reclass(X, bins):
                 ...
                 [bin[n-1], bin[n]) ->   n
                 [bin[n],      Inf) ->   n+1
-        '''
-        def findClass(x):
-            try:
-                m = max([t for t in bins if t<=x])
-                result = bins.index(m) + 2
-            except ValueError:
-                return 1
-            return result
+        @param out      Optional array for the result, it can be X itself (in-place reclassification).
+        @return         Reclassed array (the mask of a masked array is preserved).
 
+        The raster is processed by chunks of CHUNK_SIZE pixels. Pixels of 8 and 16 bit
+        integer rasters are reclassed via lookup table, other pixels via binary search in the bins.
+        '''
         tmp = bins[:]
         tmp.sort()
         if bins!=tmp:
             raise UtilsError('Reclassification error: bins must be sorted!')
-        f = np.vectorize(findClass)
-        return f(X)
+
+        # If k bins are less or equal x, then the class of x is defined by the first of the bins equal bins[k-1]
+        bins = np.array(bins)
+        classes = np.concatenate(([1], np.searchsorted(bins, bins, side='left') + 2))
+
+        data = np.asarray(ma.getdata(X))
+        if out is None:
+            out = np.empty(data.shape, dtype=np.int)
+        result = np.asarray(ma.getdata(out))
+
+        if data.dtype.kind in 'biu' and data.dtype.itemsize <= 2:
+            codes = np.dtype('uint%s' % (8*data.dtype.itemsize))
+            values = np.arange(2**(8*data.dtype.itemsize), dtype=codes).view(data.dtype)
+            lut = classes[np.searchsorted(bins, values, side='right')]
+            classify = lambda chunk: lut[chunk.view(codes)]
+        else:
+            def classify(chunk):
+                result = classes[np.searchsorted(bins, chunk, side='right')]
+                if chunk.dtype.kind == 'f':
+                    result[np.isnan(chunk)] = 1
+                return result
+
+        flat, flatResult = data.reshape(-1), result.reshape(-1)
+        if not np.may_share_memory(flatResult, result):
+            raise UtilsError('Reclassification error: output array must be contiguous!')
+        for start in xrange(0, flat.size, CHUNK_SIZE):
+            chunk = flat[start:start+CHUNK_SIZE]
+            flatResult[start:start+CHUNK_SIZE] = classify(chunk)
+
+        if ma.isMaskedArray(X) and not ma.isMaskedArray(out):
+            out = ma.array(data = out, mask = ma.getmaskarray(X).copy())
+        return out
 
 def sizes_equal(X, Y):
     '''